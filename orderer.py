@@ -1,20 +1,46 @@
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import pickle
+import re
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fractions import Fraction
+from itertools import groupby, product
+from math import comb, factorial
+
+__version__ = '0.3.0'
+
 class Symbol:
     '''
     A symbol represents any scalar or operator in an expression. It has a symbol name, a behavior (subset with special properties to which it belongs) and a dagger attribute.
 
+    A Symbol can also be a member of an indexed family, like the modes a_0, ..., a_N of a lattice: it is then instanciated with the family name and an integer index, and its name is "family_index". Inside a family Symbols are ordered by their integer index.
+
     The list of all implemented behaviors is a class attributes, as well as the list of those behaviors which are hermitian (invariant under conjugation).
     '''
     _behaviors = ['zero', 'one', 'real', 'complex', 'annihilation'] # List of implemented behaviors for symbols (order matters for comparison!)
     _hermitian_behaviors = ['zero', 'one', 'real'] # List of Hermitian behaviors for which the conj property is always False
 
-    def __init__(self, name, behavior, dag=False):
+    def __init__(self, name, behavior, dag=False, index=None):
         if behavior not in self._behaviors:
             raise Exception('Behavior "' + behavior + '" not implemented.')
 
         if ' ' in name:
             raise Exception("A Symbol's name cannot contain spaces.")
 
-        self.name = name
+        self.family = name
+        self.index = index
+        self.name = name if index is None else name + '_' + str(index)
         self.behavior = behavior
 
         if behavior in self._hermitian_behaviors:
@@ -22,29 +48,32 @@ class Symbol:
         else:
             self.dag = dag
 
+        self._str = None
+        self._plain = None
+
+        # Sort key computed once: behavior rank, then family name, then integer index (plain Symbols come first in their family)
+        i_b = self._behaviors.index(behavior)
+        if behavior == 'zero' or behavior == 'one':
+            self._order = (i_b, '', -1) # All the zeros and the ones are the same
+        else:
+            self._order = (i_b, name, -1 if index is None else index)
+
     def __eq__(a, b):
-        return str(a) == str(b) and a.behavior == b.behavior and a.dag == b.dag # The str thing just enables us to compare zeros and ones, because a girl has no name
+        return a._order == b._order and a.dag == b.dag # _order holds the behavior, family and index (all zeros and all ones share theirs)
 
     def __ne__(a,b):
         return not (a == b)
 
-    def __lt__(a, b):
-        i_b_a = a._behaviors.index(a.behavior)
-        i_b_b = b._behaviors.index(b.behavior)
+    def __hash__(self):
+        return hash((self._order, self.dag))
 
-        if i_b_a != i_b_b:
-            return i_b_a < i_b_b # We want the same order as the specified _behaviors list
+    def __lt__(a, b):
+        if a._order != b._order:
+            return a._order < b._order # We want the same order as the specified _behaviors list, then the lexicographical order of families and the order of indices
+        elif a.dag != b.dag and a.behavior != 'annihilation':
+            return a.dag # Dagged symbols come before when they commute
         else:
-            behavior = a.behavior
-            if behavior == "zero" or behavior == "one":
-                return False # All the zeros and the ones are the same
-            else:
-                if a.name != b.name:
-                    return a.name < b.name # Inside the same behavior we use the lexicographical orber
-                elif a.dag != b.dag and behavior != 'annihilation':
-                    return a.dag # Dagged symbols come before when they commute
-                else:
-                    return False
+            return False
 
     def __gt__(a, b):
         return b < a
@@ -56,19 +85,21 @@ class Symbol:
         return not a < b
 
     def __str__(self):
-        if self.behavior == 'zero':
-            return '0'
-        elif self.behavior == 'one':
-            return '1'
-        else:
-            res = self.name
-            if self.dag:
-                res = res + '*'
+        if self._str is None: # Symbols are immutable, so the string is computed once
+            if self.behavior == 'zero':
+                self._str = '0'
+            elif self.behavior == 'one':
+                self._str = '1'
+            else:
+                self._str = self.name + '*' if self.dag else self.name
 
-            return res
+        return self._str
 
     def __repr__(self):
-        return "Symbol('{}', '{}', dag={})".format(self.name, self.behavior, self.dag)
+        if self.index is None:
+            return "Symbol('{}', '{}', dag={})".format(self.name, self.behavior, self.dag)
+        else:
+            return "Symbol('{}', '{}', dag={}, index={})".format(self.family, self.behavior, self.dag, self.index)
 
     def __mul__(a, b):
         if isinstance(b, Symbol):
@@ -83,66 +114,137 @@ class Symbol:
             return NotImplemented
 
     def conj(self):
-        if self.name not in self._hermitian_behaviors:
-            return Symbol(self.name, self.behavior, not self.dag)
+        if self.behavior not in self._hermitian_behaviors:
+            return Symbol(self.family, self.behavior, not self.dag, self.index)
         else:
-            return Symbol(self.name, self.behavior, False)
+            return self
+
+    def _undagged(self):
+        if not self.dag:
+            return self
+        if self._plain is None:
+            self._plain = self.conj() # Symbols are immutable, so the undagged Symbol is built once
+
+        return self._plain
+
+    def _encode(self):
+        '''
+        Return a string that identifies the Symbol independently of any symbol bank.
+        '''
+        return '{}:{}:{}:{}'.format(self.behavior, self.family, '' if self.index is None else self.index, int(self.dag))
+
+    @staticmethod
+    def _decode(code):
+        behavior, rest = code.split(':', 1)
+        family, index, dag = rest.rsplit(':', 2)
+
+        return Symbol(family, behavior, dag == '1', None if index == '' else int(index))
 
 ZERO = Symbol('0', 'zero')
 ONE = Symbol('1', 'one')
 
-class Term:
+class SymbolBank:
     '''
-    A Term is a product of Symbols and can be instanciated as such. It has a list of symbols as its only attribute and can be bijectively represented by a string in the form
-        "s_1^k_1 s_2^k_2 ... s_n^k_n"
-    where the s_is are Symbols or conjugates of Symbols. Some default symbols are defined in the class attribute _default_bank that is used by default when instanciated a Term using such a string.
+    A SymbolBank is the set of Symbols that can be used when instanciating a Term from a string, indexed by name. ZERO and ONE always belong to it.
 
-    Terms are totally ordered in a recursive manner according to the order relationship "I naturally write this Term to the *right* of that Term in an Expression".
+    The bank is validated as Symbols are added to it (two Symbols cannot share a name) and it can be frozen, after which it cannot be modified anymore. Lists of Symbols are accepted wherever a bank is expected and converted on the fly.
     '''
-    _default_bank = [Symbol('k', 'real'), Symbol('n', 'real'), Symbol('x', 'real'), Symbol('xi', 'complex'), Symbol('zeta', 'complex'), Symbol('z', 'complex'), Symbol('a', 'annihilation'), Symbol('b', 'annihilation')]
+    def __init__(self, symbols=[], frozen=False):
+        self._symbols = {ZERO.name: ZERO, ONE.name: ONE}
+        self._members = {} # Members of indexed families already looked up, by name
+        self._frozen = False
 
-    def __init__(self, info=[], bank=None):
-        if bank is None:
-            bank = self._default_bank
+        for s in symbols:
+            self.add(s)
 
-        if isinstance(info, str):
-            if any(bank.count(s) > 1 for s in bank):
-                raise Exception('The symbol bank given is ambiguous.')
+        self._frozen = frozen
 
-            if ZERO not in bank:
-                bank.append(ZERO)
+    def add(self, symbol):
+        if self._frozen:
+            raise Exception('The symbol bank is frozen.')
 
-            if ONE not in bank:
-                bank.append(ONE)
+        if symbol.name in self._symbols:
+            if symbol == ZERO or symbol == ONE:
+                return # Already in every bank
 
-            infos = info.split(' ')
+            raise Exception('The symbol bank given is ambiguous.')
 
-            symbols = []
+        self._symbols[symbol.name] = symbol
 
-            for i in infos:
-                i_sym_pow = i.split('^')
-                i_sym, i_pow = (i_sym_pow[0], int(i_sym_pow[1])) if '^' in i else (i, 1)
+    def freeze(self):
+        self._frozen = True
 
-                if not i_sym:
-                    i_sym = '1' # Simplest way to implement the fact that an empty product is 1
+        return self
 
-                if i_sym[-1] == '*':
-                    i_sym = i_sym[:-1]
-                    dag = True
-                else:
-                    dag = False
-                
-                try:
-                    new_s = next(s for s in bank if s.name == i_sym)
-                except StopIteration:
-                    raise Exception("Unknown symbol '" + i_sym + "'.")
-
-                if dag:
-                    new_s = new_s.conj()
-                
-                symbols.extend([new_s] * i_pow)
-
-            self.__init__(symbols)
+    def __getitem__(self, name):
+        '''
+        Return the Symbol of the bank with that name. A name "family_i" where i is an integer and family is the name of a Symbol of the bank stands for the member of index i of that family.
+        '''
+        try:
+            return self._symbols[name]
+        except KeyError:
+            pass
+
+        try:
+            return self._members[name]
+        except KeyError:
+            pass
+
+        family, _, index = name.rpartition('_')
+        if family in self._symbols and index.isdigit():
+            s = self._symbols[family]
+            member = Symbol(family, s.behavior, s.dag, int(index))
+            self._members[name] = member # Not a modification of the bank, only a memo
+
+            return member
+
+        raise Exception("Unknown symbol '" + name + "'.")
+
+    def __contains__(self, name):
+        '''
+        Return True if __getitem__ resolves the name, members of indexed families included.
+        '''
+        try:
+            self[name]
+        except Exception:
+            return False
+
+        return True
+
+    def __iter__(self):
+        return iter(self._symbols.values())
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __repr__(self):
+        return 'SymbolBank({})'.format([s for s in self if s != ZERO and s != ONE])
+
+    @staticmethod
+    def _coerce(bank):
+        '''
+        Return bank itself if it is a SymbolBank, the default bank if it is None and a new SymbolBank of its Symbols otherwise.
+        '''
+        if bank is None:
+            return Term._default_bank
+        elif isinstance(bank, SymbolBank):
+            return bank
+        else:
+            return SymbolBank(bank)
+
+class Term:
+    '''
+    A Term is a product of Symbols and can be instanciated as such. It has a list of symbols as its only attribute and can be bijectively represented by a string in the form
+        "s_1^k_1 s_2^k_2 ... s_n^k_n"
+    where the s_is are Symbols or conjugates of Symbols. Some default symbols are defined in the frozen SymbolBank _default_bank that is used by default when instanciated a Term using such a string.
+
+    Terms are totally ordered in a recursive manner according to the order relationship "I naturally write this Term to the *right* of that Term in an Expression".
+    '''
+    _default_bank = SymbolBank([Symbol('k', 'real'), Symbol('n', 'real'), Symbol('x', 'real'), Symbol('xi', 'complex'), Symbol('zeta', 'complex'), Symbol('z', 'complex'), Symbol('a', 'annihilation'), Symbol('b', 'annihilation')], frozen=True)
+
+    def __init__(self, info=[], bank=None):
+        if isinstance(info, str):
+            self.__init__(self._parse(info, SymbolBank._coerce(bank)))
         elif isinstance(info, list):
             symbols = info
             if ZERO in symbols:
@@ -151,65 +253,113 @@ class Term:
                 self.symbols = [ONE] # An empty product is equal to 1
             else:
                 self.symbols = sorted([s for s in symbols if s != ONE]) # Thank God sorted() is stable!
+
+            self._str = None
+            self._split_scalars()
+            self._index_modes()
         else:
             raise Exception('Term constructor argument should be a string or a list of Symbols.')
 
+    @staticmethod
+    def _parse(info, bank):
+        '''
+        Return the list of Symbols written in the string info, in the written order, bank being a SymbolBank (or anything that maps names to Symbols).
+        '''
+        infos = info.split(' ')
+
+        symbols = []
+
+        for i in infos:
+            i_sym_pow = i.split('^')
+            i_sym, i_pow = (i_sym_pow[0], int(i_sym_pow[1])) if '^' in i else (i, 1)
+
+            if not i_sym:
+                i_sym = '1' # Simplest way to implement the fact that an empty product is 1
+
+            if i_sym[-1] == '*':
+                i_sym = i_sym[:-1]
+                dag = True
+            else:
+                dag = False
+            
+            new_s = bank[i_sym]
+
+            if dag:
+                new_s = new_s.conj()
+            
+            symbols.extend([new_s] * i_pow)
+
+        return symbols
+
     def __eq__(A, B):
         return A.symbols == B.symbols
 
+    def __hash__(self):
+        return hash(tuple(self.symbols))
+
     def __lt__(A, B):
         '''
         Recursively determine if A is 'smaller' than B, meaning that A would be naturally written after B.
         '''
         # Base cases
-        if ZERO in B.symbols:
+        if B.symbols[0].behavior == 'zero': # ZERO is always alone in a Term
             return False
-        elif B.symbols == [ONE]:
-            return ZERO in A.symbols
+        elif A.symbols[0].behavior == 'zero':
+            return True
+
+        # The comparison goes down the modes of A and B in dominance order, the k-th step comparing what remains once the k first dominant modes are deleted
+        order_a = A._dominance_order()
+        order_b = B._dominance_order()
 
-        # First compare the total degree of A and B according to complex and annihilation symbols (becauses complex symbols are supposed to vary in time, so that they count)
-        # Note that if this comparison holds through the recursion
-        deg_a = A._num_symbols_like(behavior='complex') + A._num_symbols_like(behavior='annihilation')
-        deg_b = B._num_symbols_like(behavior='complex') + B._num_symbols_like(behavior='annihilation')
+        # The degree counts the complex and annihilation symbols (becauses complex symbols are supposed to vary in time, so that they count)
+        deg_a = A._degree
+        deg_b = B._degree
 
-        if deg_a != deg_b:
-            return deg_a < deg_b
+        for k in range(len(order_a) + 1):
+            if k == len(order_b): # What remains of B is 1
+                return False
+            elif k == len(order_a):
+                return True
 
-        # From now on we only consider the dominant symbol in A and B
-        dom_a = A._dominant()
-        dom_b = B._dominant()
+            # First compare the total degree of A and B
+            if deg_a != deg_b:
+                return deg_a < deg_b
 
-        # First compare the dominant symbols' behaviors
-        if dom_a.behavior != dom_b.behavior:
-            return dom_a < dom_b
+            # From now on we only consider the dominant symbol in A and B
+            dom_a = order_a[k]
+            dom_b = order_b[k]
 
-        # Then compare their degree according to the dominant symbol
-        deg_dom_a = A._num_symbols_like(name=dom_a.name, behavior=dom_a.behavior)
-        deg_dom_b = B._num_symbols_like(name=dom_b.name, behavior=dom_b.behavior)
+            # First compare the dominant symbols' behaviors
+            if dom_a.behavior != dom_b.behavior:
+                return dom_a < dom_b
 
-        if deg_dom_a != deg_dom_b:
-            return deg_dom_a < deg_dom_b
+            # Then compare their degree according to the dominant symbol
+            _, len_a, mask_a = A._modes[dom_a]
+            _, len_b, mask_b = B._modes[dom_b]
 
-        # Then compare the name of the dominant symbol (reverse order)
-        if dom_a.name != dom_b.name:
-            return dom_a.name > dom_b.name
+            if len_a != len_b:
+                return len_a < len_b
 
-        dom = dom_a # == dom_b
+            # Then compare the dominant symbols themselves (reverse order)
+            if dom_a != dom_b:
+                return dom_b < dom_a
 
-        # Then compare the number of daggers on the dominant symbol
-        num_dags_a = A._num_symbols_like(name=dom.name, behavior=dom.behavior, dag=True)
-        num_dags_b = B._num_symbols_like(name=dom.name, behavior=dom.behavior, dag=True)
+            # Then compare the number of daggers on the dominant symbol
+            num_dags_a = bin(mask_a).count('1')
+            num_dags_b = bin(mask_b).count('1')
 
-        if num_dags_a != num_dags_b:
-            return num_dags_a < num_dags_b
+            if num_dags_a != num_dags_b:
+                return num_dags_a < num_dags_b
 
-        # Then compare the "normalness" of both terms according to the dominant symbol
-        same_normalness = (not A._more_normal_than(B, dom)) and (not B._more_normal_than(A, dom))
-        if not same_normalness:
-            return B._more_normal_than(A, dom)
+            # Then compare the "normalness" of both terms according to the dominant symbol: the first operator where they differ is dagged in the more normal one
+            if mask_a != mask_b:
+                diff = mask_a ^ mask_b
+                return bool(mask_b & diff & -diff)
 
-        # Otherwise delete the dominant part and compare the rest
-        return A._delete_dominant() < B._delete_dominant()
+            # Otherwise delete the dominant mode and compare the rest
+            if dom_a.behavior == 'complex' or dom_a.behavior == 'annihilation':
+                deg_a -= len_a
+                deg_b -= len_b
 
     def __gt__(A, B):
         return B < A
@@ -224,27 +374,71 @@ class Term:
         return not A == B
 
     def __str__(self):
-        groups = self._group_symbols()
-        str_group = lambda x: str(x[0]) + ("^" + str(x[1]) if x[1] > 1 else "")
-        
-        return ' '.join(map(str_group, groups))
+        if self._str is None: # Terms are immutable, so the string is computed once
+            groups = self._group_symbols()
+            str_group = lambda x: str(x[0]) + ("^" + str(x[1]) if x[1] > 1 else "")
+
+            self._str = ' '.join(map(str_group, groups))
+
+        return self._str
 
     def __repr__(self):
         return "Term('{}')".format(str(self))
 
     def __mul__(A, B):
         if isinstance(B, Term):
-            return Term(A.symbols + B.symbols)
+            return A._merge(B)
         elif isinstance(B, Symbol):
-            return Term(A.symbols + [B])
+            return A._merge(Term([B]))
         else:
             return NotImplemented
 
     def __rmul__(A, B):
         if isinstance(B, Term):
-            return Term(B.symbols + A.symbols)
+            return B._merge(A)
         elif isinstance(B, Symbol):
-            return Term([B] + A.symbols)
+            return Term([B])._merge(A)
+
+    @classmethod
+    def _from_sorted(cls, symbols):
+        '''
+        Build a Term directly from a list of Symbols already in canonical order (no ONE, no ZERO unless alone), without sorting nor validating it.
+        '''
+        t = cls.__new__(cls)
+        t.symbols = symbols
+        t._str = None
+        t._split_scalars()
+        t._index_modes()
+
+        return t
+
+    def _merge(A, B):
+        '''
+        Return the product A B by merging the sorted Symbols of A and B in linear time. On ties the Symbols of A come first, which is exactly what the stable sort of A.symbols + B.symbols would do, so the order of the non-commuting operators is kept.
+        '''
+        a = A.symbols
+        b = B.symbols
+
+        if a[0].behavior == 'zero' or b[0].behavior == 'one':
+            return A
+        elif b[0].behavior == 'zero' or a[0].behavior == 'one':
+            return B
+
+        res = []
+        i = 0
+        j = 0
+        while i < len(a) and j < len(b):
+            if b[j] < a[i]:
+                res.append(b[j])
+                j += 1
+            else:
+                res.append(a[i])
+                i += 1
+
+        res.extend(a[i:])
+        res.extend(b[j:])
+
+        return Term._from_sorted(res)
 
     def __add__(A, B):
         if isinstance(B, Term):
@@ -259,27 +453,103 @@ class Term:
 
     def is_normal_ordered(self, symbol=None):
         if symbol is not None:
-            symbols = [s for s in self.symbols if s.name == symbol.name and s.behavior == symbol.behavior]
-            switch = False
+            return symbol.behavior != 'annihilation' or symbol.name not in self._disorders
+        else:
+            return self._disorder is None
 
-            for s in symbols:
-                if not switch:
-                    switch = not s.dag
-                else:
-                    if s.dag:
-                        break
-            else:
-                return True
+    def _split_scalars(self):
+        '''
+        Split the sorted Symbols of the Term into its commuting scalar monomial (the list scalars, which can contain ZERO or ONE) and its operator word (the list word of its annihilation Symbols), which come last.
+        '''
+        symbols = self.symbols
 
-            return False
-        else:
-            for s in self._symbols_in():
-                if not self.is_normal_ordered(symbol=s):
-                    break
-            else:
-                return True
+        k = len(symbols)
+        while k > 0 and symbols[k - 1].behavior == 'annihilation':
+            k -= 1
 
-            return False
+        self.scalars = symbols[:k]
+        self.word = symbols[k:]
+
+    def _word_term(self):
+        '''
+        Return the Term made of the operator word only.
+        '''
+        return Term._from_sorted(self.word) if self.word else Term([ONE])
+
+    def _index_modes(self):
+        '''
+        Index the Term by mode at construction: _modes maps each undagged Symbol of the Term, in increasing order, to the triple (position of its first operator, number of operators, dag bits) where the k-th bit tells whether its k-th operator is dagged. _degree is the number of complex and annihilation Symbols.
+
+        Since the operators of a same mode are contiguous in a sorted Term, a mode is normal-ordered iff none of its annihilators is directly followed by one of its creators, which can be read on its dag bits: _disorders maps the name of each annihilation Symbol that is not normal-ordered to the position of its first "a a*" pair, and _disorder is the position of the first such pair in the Term (None if the Term is normal-ordered).
+        '''
+        self._modes = {}
+        self._disorders = {}
+        self._disorder = None
+        self._degree = 0
+        self._dominance = None
+        self._charge = None
+
+        symbols = self.symbols
+        j = 0
+        while j < len(symbols):
+            s = symbols[j]
+
+            mask = 0
+            k = j
+            while k < len(symbols) and symbols[k]._order == s._order:
+                if symbols[k].dag:
+                    mask |= 1 << (k - j)
+                k += 1
+
+            self._modes[s._undagged()] = (j, k - j, mask)
+
+            if s.behavior == 'annihilation':
+                pairs = ~mask & (mask >> 1) # Bit i is set iff operator i is an "a" followed by an "a*"
+                if pairs:
+                    self._disorders[s.name] = j + (pairs & -pairs).bit_length() - 1
+                    if self._disorder is None:
+                        self._disorder = self._disorders[s.name]
+
+            if s.behavior == 'complex' or s.behavior == 'annihilation':
+                self._degree += k - j
+
+            j = k
+
+    def charge(self):
+        '''
+        Return the charge vector of the Term, the number of a* minus the number of a for each annihilation Symbol a, as the tuple of the couples (name, charge) of the modes with a nonzero charge, sorted by name. A Term of charge q for the mode a satisfies [a* a, t] = q t.
+        '''
+        if self._charge is None:
+            res = []
+            for s, (_, length, mask) in self._modes.items():
+                if s.behavior == 'annihilation':
+                    q = 2 * bin(mask).count('1') - length
+                    if q:
+                        res.append((s.name, q))
+
+            self._charge = tuple(sorted(res))
+
+        return self._charge
+
+    def _dominance_order(self):
+        '''
+        Return the list of the undagged Symbols of the Term (ZERO and ONE excluded) in the order in which they are dominant: by decreasing behavior, then in increasing order for a same behavior.
+        '''
+        if self._dominance is None:
+            groups = [list(g) for _, g in groupby(self._modes, key=lambda s: s.behavior)]
+            self._dominance = [s for g in groups[::-1] for s in g if s.behavior != 'zero' and s.behavior != 'one']
+
+        return self._dominance
+
+    def _encode(self):
+        '''
+        Return the canonical string encoding of the Term, independent of any symbol bank.
+        '''
+        return ' '.join(s._encode() for s in self.symbols)
+
+    @staticmethod
+    def _decode(code):
+        return Term._from_sorted([Symbol._decode(c) for c in code.split(' ')])
 
     def _group_symbols(self):
         '''
@@ -304,44 +574,43 @@ class Term:
 
         return res
 
+    def _mode_words(self):
+        '''
+        Return the couple (scalars, words) where scalars is the list of the non-operator Symbols of the Term (ZERO and ONE excluded) and words maps the name of each annihilation Symbol to the list of dag attributes of its operators, in order.
+        '''
+        scalars = [s for s in self.scalars if s.behavior != 'zero' and s.behavior != 'one']
+        words = {}
+
+        for s in self.word:
+            words.setdefault(s.name, []).append(s.dag)
+
+        return scalars, words
+
     def _num_symbols_like(self, name=None, behavior=None, dag=None):
         '''
         Return the number of Symbols in a Term matching the given properties when specified.
         '''
-        symbol_selection = self.symbols
+        res = 0
+        for s, (_, length, mask) in self._modes.items():
+            if (name is None or s.name == name) and (behavior is None or s.behavior == behavior):
+                num_dags = bin(mask).count('1')
+                res += length if dag is None else num_dags if dag else length - num_dags
 
-        if name is not None:
-            symbol_selection = [s for s in symbol_selection if s.name == name]
-        if behavior is not None:
-            symbol_selection = [s for s in symbol_selection if s.behavior == behavior]
-        if dag is not None:
-            symbol_selection = [s for s in symbol_selection if s.dag == dag]
-
-        return len(symbol_selection)
+        return res
 
     def _symbols_in(self):
         '''
         Return the ordered list of Symbols in a Term with no duplicates, all symbols having dag == False.
         '''
-        symbols_undagged = [Symbol(s.name, s.behavior, dag=False) for s in self.symbols]
-
-        res = []
-        for s in symbols_undagged:
-            if s not in res:
-                res.append(s)
-
-        return res
+        return list(self._modes)
 
     def _dominant(self):
         '''
         Return the Symbol with the highest ordering priority in a Term, regardless of its dag attribute.
         '''
-        symbols = self._symbols_in()
-        max_behavior = max(self.symbols).behavior
+        order = self._dominance_order()
 
-        max_behavior_symbols = [s for s in symbols if s.behavior == max_behavior]
-
-        return min(max_behavior_symbols)
+        return order[0] if order else self.symbols[0]
 
     def _more_normal_than(A, B, sym):
         '''
@@ -350,69 +619,56 @@ class Term:
         if sym.behavior != 'annihilation':
             return False
 
-        sym_list_a = [s for s in A.symbols if s == sym or s == sym.conj()]
-        sym_list_b = [s for s in B.symbols if s == sym or s == sym.conj()]
+        _, len_a, mask_a = A._modes.get(sym, (0, 0, 0))
+        _, len_b, mask_b = B._modes.get(sym, (0, 0, 0))
 
-        if len(sym_list_a) != len(sym_list_b):
+        if len_a != len_b:
             raise Exception('Compared terms do not have the same order in ' + sym.name + '.')
 
-        n = len(sym_list_a)
-        go_on = True
-        k = 0
-
-        while go_on and k < n:
-            d_a = sym_list_a[k].dag
-            d_b = sym_list_b[k].dag
-
-            if d_a and not d_b :
-                return True
-
-            go_on = (d_a == d_b)
-            k += 1
+        diff = mask_a ^ mask_b
 
-        return False
+        return bool(mask_a & diff & -diff) # The first operator where they differ is dagged in A
 
     def _delete_dominant(self):
         '''
         Return the same Term with all occurencces of its dominant symbol deleted.
         '''
         dom = self._dominant()
-        new_symbols = [s for s in self.symbols if s != dom and s.conj() != dom]
+        if dom not in self._modes or dom.behavior == 'one':
+            return Term([ONE])
+        j, length, _ = self._modes[dom]
+        symbols = self.symbols[:j] + self.symbols[j + length:]
 
-        return Term(new_symbols)
+        return Term._from_sorted(symbols) if symbols else Term([ONE])
 
 class Expression:
-    def __init__(self, info=[], bank=None):
-        if bank is None:
-            bank = Term._default_bank
+    '''
+    An Expression is a sum of Terms, stored as the list of its Terms in decreasing order (a Term appearing k times has the factor k). It can be instanciated from such a list or from a string in the form
+        "k_1 t_1 + k_2 t_2 + ... + k_n t_n"
+    where the t_is are strings of Terms and the k_is optional integer factors.
 
+    Expressions are normal-ordered at instanciation, unless lazy is True: the Terms are then kept as they are until normal_order() or iter_normal_ordered() is called, and sums and products involving a lazy Expression are lazy too.
+    '''
+    _compiled = {} # Cache of the functions generated by compile(), keyed by the string of the Expression
+    _compiled_max_entries = 256 # The cache is cleared when it reaches this size
+    cache = None # Optional NormalOrderCache consulted by normal_order() before expanding a Term
+
+    def __init__(self, info=[], bank=None, lazy=False):
         if isinstance(info, str):
             if not info:
-                self.__init__()
+                self.__init__(lazy=lazy)
             else:
+                bank = SymbolBank._coerce(bank) # Converted once for all the Terms
                 infos = info.split('+')
                 terms = []
 
                 for i in infos:
-                    info = i.strip()
-
-                    for k, c in enumerate(info):
-                        if not c.isdigit():
-                            int_until = k
-                            break
-                    else:
-                        int_until = len(info)
-
-                    try:
-                        factor = int(info[:int_until])
-                    except ValueError:
-                        factor = 1
-
-                    term = Term(info[int_until:].strip())
+                    factor, info = self._parse_factor(i)
+                    term = Term(info, bank)
 
                     terms.extend([term] * factor)
 
-                self.__init__(terms)
+                self.__init__(terms, lazy=lazy)
         elif isinstance(info, list):
             if not info or all(t == Term('0') for t in info):
                 self.terms = [Term('0')] # An empty sum is zero
@@ -420,16 +676,48 @@ class Expression:
                 self.terms = sorted(info)[::-1] # Because we want the Terms in decreasing order
                 self.terms = [t for t in self.terms if t != Term('0')] # then we remove all occurences of 0
 
-            self.normal_order()
+            self._lazy = lazy
+            if not lazy:
+                self.normal_order()
         else:
             raise Exception('Expression constructor argument should be a string or a list of Terms.')
 
+    @staticmethod
+    def _parse_factor(info):
+        '''
+        Split the string of a Term preceded by an optional integer factor into the couple (factor, Term string).
+        '''
+        info = info.strip()
+
+        for k, c in enumerate(info):
+            if not c.isdigit():
+                int_until = k
+                break
+        else:
+            int_until = len(info)
+
+        try:
+            factor = int(info[:int_until])
+        except ValueError:
+            factor = 1
+
+        return factor, info[int_until:].strip()
+
     def __eq__(E, F):
-        return E.terms == F.terms
+        return E._normal_ordered().terms == F._normal_ordered().terms
+
+    def _normal_ordered(self):
+        '''
+        Return the Expression itself, or a normal-ordered copy of it if it is lazy, for the operations which read the Terms as normal-ordered monomials.
+        '''
+        if self._lazy:
+            return Expression(self.terms)
+
+        return self
 
     def __add__(E, F):
         if isinstance(F, Expression):
-            return Expression(E.terms + F.terms)
+            return Expression(E.terms + F.terms, lazy=E._lazy or F._lazy)
         elif isinstance(F, Symbol):
             return E + Expression([Term([F])])
         elif isinstance(F, Term):
@@ -442,7 +730,7 @@ class Expression:
 
     def __mul__(E, F):
         if isinstance(F, Symbol) or isinstance(F, Term):
-            return Expression([t * F for t in E.terms])
+            return Expression([t * F for t in E.terms], lazy=E._lazy)
         elif isinstance(F, Expression):
             terms = []
 
@@ -450,21 +738,83 @@ class Expression:
                 for t in F.terms:
                     terms.append(e * t)
 
-            return Expression(terms)
+            return Expression(terms, lazy=E._lazy or F._lazy)
         else:
             return NotImplemented
 
     def __rmul__(E, F):
         if isinstance(F, Symbol) or isinstance(F, Term):
-            return Expression([F * t for t in E.terms])
+            return Expression([F * t for t in E.terms], lazy=E._lazy)
         else:
             return NotImplemented
 
+    @classmethod
+    def _from_sorted(cls, terms):
+        '''
+        Build a normal-ordered Expression directly from a list of normal-ordered Terms already in decreasing order (without Term('0')), without sorting nor normal ordering it.
+        '''
+        e = cls.__new__(cls)
+        e.terms = terms or [Term('0')]
+        e._lazy = False
+
+        return e
+
+    def _merge(E, F):
+        '''
+        Return the sum of the normal-ordered Expressions E and F by merging their sorted Terms in linear time.
+        '''
+        a = [t for t in E.terms if ZERO not in t.symbols]
+        b = [t for t in F.terms if ZERO not in t.symbols]
+
+        res = []
+        i = 0
+        j = 0
+        while i < len(a) and j < len(b):
+            if a[i] < b[j]:
+                res.append(b[j])
+                j += 1
+            else:
+                res.append(a[i])
+                i += 1
+
+        res.extend(a[i:])
+        res.extend(b[j:])
+
+        return Expression._from_sorted(res)
+
+    @property
+    def terms(self):
+        return self._terms
+
+    @terms.setter
+    def terms(self, terms):
+        self._terms = terms
+        self._str = None # The cached string and charge index are only valid for these Terms
+        self._charges = None
+
     def __str__(self):
-        groups = self._group_terms()
-        str_group = lambda x: (str(x[1]) + ' ' if x[1] != 1 else '') + (str(x[0]) if x[1] == 1 or x[0] != Term() else '')
-        
-        return ' + '.join(map(str_group, groups)).strip()
+        if self._str is None:
+            self._str = ' + '.join(self._str_groups())
+
+        return self._str
+
+    def _str_groups(self):
+        '''
+        Yield the strings of the groups of equal Terms of the Expression, in the order of __str__.
+        '''
+        for t, factor in self._group_terms():
+            yield ((str(factor) + ' ' if factor != 1 else '') + (str(t) if factor == 1 or t != Term() else '')).strip()
+
+    def write_to(self, fileobj):
+        '''
+        Write the string of the Expression to the text file object fileobj one group of Terms at a time, without building the whole string.
+        '''
+        if self._str is not None:
+            fileobj.write(self._str)
+            return
+
+        for i, g in enumerate(self._str_groups()):
+            fileobj.write(' + ' + g if i else g)
 
     def __repr__(self):
         return "Expression('{}')".format(str(self))
@@ -472,52 +822,2127 @@ class Expression:
     def conj(self):
         terms = [t.conj() for t in self.terms]
 
-        return Expression(terms)
+        return Expression(terms, lazy=self._lazy)
+
+    def commutator(E, F):
+        '''
+        Return the couple of Expressions (P, N) such that the commutator E F - F E is equal to P - N, the Terms common to both products being cancelled. Since Expressions only have positive factors, the negative part is returned separately.
+        '''
+        E = E._normal_ordered()
+        F = F._normal_ordered()
+
+        return Expression._cancelled(E * F, F * E)
+
+    @staticmethod
+    def _cancelled(P, N):
+        '''
+        Return the couple of Expressions standing for P - N once the Terms common to P and N have been cancelled.
+        '''
+        p = Counter(t for t in P.terms if ZERO not in t.symbols)
+        n = Counter(t for t in N.terms if ZERO not in t.symbols)
+        common = p & n
+
+        return Expression(list((p - common).elements())), Expression(list((n - common).elements()))
+
+    @staticmethod
+    def _signed_groups(P, N):
+        '''
+        Return the list of couples (Term, signed factor) of P - N in decreasing order of Terms.
+        '''
+        groups = [(t, c) for t, c in P._group_terms() if ZERO not in t.symbols]
+        groups += [(t, -c) for t, c in N._group_terms() if ZERO not in t.symbols]
+
+        return sorted(groups, key=lambda g: g[0], reverse=True)
+
+    @staticmethod
+    def _signed_str(P, N):
+        '''
+        Return the string of P - N, written like the string of an Expression with " - " before the Terms of N.
+        '''
+        res = ''
+        for t, c in Expression._signed_groups(P, N):
+            s = (str(abs(c)) + ' ' if abs(c) != 1 else '') + (str(t) if abs(c) == 1 or t != Term() else '')
+            if not res:
+                res = ('- ' if c < 0 else '') + s.strip()
+            else:
+                res += (' - ' if c < 0 else ' + ') + s.strip()
+
+        return res or '0'
+
+    def to_sparse_matrix(self, cutoffs, values=None):
+        '''
+        Return the matrix of the Expression on the truncated Fock space as a scipy CSR matrix.
+
+        cutoffs maps the name of each annihilation Symbol to the dimension of its truncated Fock space, the modes being tensored in the lexicographical order of their names. values maps the names of the real and complex Symbols to numbers, a dagged Symbol taking the conjugate value.
+        '''
+        try:
+            import numpy as np # Imported here so that loading the module does not pay for numpy and scipy
+            from scipy import sparse
+        except ImportError:
+            raise Exception('Sparse matrix export requires numpy and scipy.')
+
+        if values is None:
+            values = {}
+
+        modes = sorted(cutoffs)
+        dim = 1
+        for m in modes:
+            dim *= cutoffs[m]
+
+        dtype = complex if any(np.iscomplexobj(v) for v in values.values()) else float
+        res = sparse.csr_matrix((dim, dim), dtype=dtype)
+
+        ladders = {m: sparse.diags(np.sqrt(np.arange(1, cutoffs[m])), 1, format='csr', dtype=dtype) for m in modes}
+        creations = {m: ladders[m].T.tocsr() for m in modes}
+        identities = {m: sparse.identity(cutoffs[m], format='csr', dtype=dtype) for m in modes}
+        words = {} # (mode, dags of the word) -> matrix of the word on that mode, shared by all the Terms
+
+        for t, factor in self._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            coef = factor
+            mode_words = {}
+
+            for s in t.symbols:
+                if s.behavior == 'real' or s.behavior == 'complex':
+                    if s.name not in values:
+                        raise Exception("No value given for symbol '" + s.name + "'.")
+                    coef = coef * (np.conj(values[s.name]) if s.dag else values[s.name])
+                elif s.behavior == 'annihilation':
+                    if s.name not in cutoffs:
+                        raise Exception("No cutoff given for mode '" + s.name + "'.")
+                    mode_words.setdefault(s.name, []).append(s.dag)
+
+            mat = None
+            for m in modes:
+                key = (m, tuple(mode_words.get(m, ())))
+                if key not in words:
+                    word = identities[m]
+                    for dag in key[1]:
+                        word = word @ (creations[m] if dag else ladders[m])
+                    words[key] = word
+
+                mat = words[key] if mat is None else sparse.kron(mat, words[key], format='csr')
+
+            if mat is None:
+                mat = sparse.identity(dim, format='csr', dtype=dtype) # No mode at all
+
+            res = res + coef * mat
+
+        return res.tocsr()
+
+    def compile(self):
+        '''
+        Return a function evaluating the Expression (a being replaced by a value and a* by its conjugate) from a dict mapping each Symbol name to a number or an array.
+
+        The function is generated as straight-line Python code where the polynomial is factored in a Horner-like manner, one Symbol after the other, and each needed power of each Symbol is computed only once. Every Horner step is bound to a local variable, so that the code is not nested however many Symbols there are. Generated functions are cached. A lazy Expression is normal-ordered first.
+        '''
+        e = self._normal_ordered()
+        key = str(e)
+        if key in self._compiled:
+            return self._compiled[key]
+
+        variables = [] # Couples (name, dag) in order of appearance
+        poly = []
+        for t, c in e._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            exps = {}
+            for s, p in t._group_symbols():
+                if s.behavior != 'one':
+                    v = (s.name, s.dag)
+                    if v not in variables:
+                        variables.append(v)
+                    exps[v] = exps.get(v, 0) + p
+
+            poly.append((exps, c))
+
+        poly = [(tuple(exps.get(v, 0) for v in variables), c) for exps, c in poly]
+        powers = set()
+
+        def power(i, p):
+            if p == 1:
+                return 'x{}'.format(i)
+            powers.add((i, p))
+            return 'x{}_{}'.format(i, p)
+
+        steps = [] # Lines binding the Horner steps to the locals t0, t1, ...
+
+        def step(expr):
+            steps.append('    t{} = {}'.format(len(steps), expr))
+            return 't{}'.format(len(steps) - 1)
+
+        def mul(factor, expr):
+            return factor if expr == '1' else step('{}*{}'.format(factor, expr))
+
+        def horner(poly):
+            todo = [(poly, 0, None)] # Factorizations of poly on the Symbols from i on, done once all its sub-polynomials are (exps not None)
+            done = [] # Variables or constants of the factorized sub-polynomials
+
+            while todo:
+                poly, i, exps = todo.pop()
+
+                if exps is None:
+                    if not poly:
+                        done.append('0')
+                    elif i == len(variables):
+                        done.append(str(sum(c for _, c in poly)))
+                    else:
+                        exps = sorted(set(e[i] for e, _ in poly))
+                        todo.append((poly, i, exps))
+                        todo.extend(([(e, c) for e, c in poly if e[i] == k], i + 1, None) for k in reversed(exps))
+                    continue
+
+                subs = done[-len(exps):]
+                del done[-len(exps):]
+
+                res = subs[-1]
+                for k in range(len(exps) - 1, 0, -1):
+                    res = step(subs[k - 1] + ' + ' + mul(power(i, exps[k] - exps[k - 1]), res))
+
+                if exps[0] > 0:
+                    res = mul(power(i, exps[0]), res)
+
+                done.append(res)
+
+            return done[0]
+
+        body = horner(poly)
+
+        lines = ['def _compiled(values):']
+        for i, (name, dag) in enumerate(variables):
+            if dag:
+                lines.append('    x{} = values[{!r}].conjugate()'.format(i, name))
+            else:
+                lines.append('    x{} = values[{!r}]'.format(i, name))
+        for i, p in sorted(powers):
+            lines.append('    x{0}_{1} = x{0}**{1}'.format(i, p))
+        lines.extend(steps)
+        lines.append('    return ' + body)
+
+        source = '\n'.join(lines)
+        namespace = {}
+        exec(source, namespace)
+
+        fn = namespace['_compiled']
+        fn.source = source
+        if len(self._compiled) >= self._compiled_max_entries:
+            self._compiled.clear()
+        self._compiled[key] = fn
+
+        return fn
 
     def normal_order(self):
-        for i, t in enumerate(self.terms):
-            if not t.is_normal_ordered():
-                # len(t.symbols) >= 2, otherwise t would automatically be normal-ordered
-                symbols = t.symbols
-                terms = self.terms
-                e_before = Expression(terms[:i])
-                e_after = Expression(terms[i+1:])
-
-                for j, s in enumerate(symbols):
-                    s1 = symbols[j]
-                    s2 = symbols[j + 1]
-                    if s2.dag and not s1.dag:
-                        t_before = Term(symbols[:j])
-                        t_after = Term(symbols[j+2:])
-                        t_inv = Term([s2, s1])
-                        
-                        new_part = t_before * Expression([t_inv, Term([ONE])]) * t_after
-
-                        new_expr = e_before + new_part + e_after
-                        
-                        self.terms = new_expr.terms
-                        break
+        self._lazy = False
 
-                break
-        else:
+        if all(t.is_normal_ordered() for t in self.terms):
             return
 
-        self.normal_order()
+        terms = []
+        memo = {} # Terms differing only by their scalars share the expansion of their operator word
+        for t, factor in self._group_terms():
+            if t.is_normal_ordered():
+                terms.extend([t] * factor)
+            else:
+                terms.extend(self._normal_order_term(t, memo) * factor)
 
-    def _group_terms(self):
-        terms = self.terms
-        
-        res = []
-        i = 0
-        while i < len(terms):
-            t = terms[i]
-            j = 1
-            while i + j < len(terms) and terms[i + j] == t:
-                j += 1
-            
-            g = (t, j)
-            res.append(g)
+        self.terms = Expression(terms).terms
 
-            i += j
+    def charge_index(self):
+        '''
+        Return the dict mapping each charge vector (see Term.charge) of the Expression to the list of the couples (Term, factor) of that charge, built once.
+        '''
+        if self._charges is None:
+            self._charges = {}
+            for t, factor in self._group_terms():
+                if ZERO not in t.symbols:
+                    self._charges.setdefault(t.charge(), []).append((t, factor))
 
-        return res
\ No newline at end of file
+        return self._charges
+
+    def commutes_with_number(self, *modes):
+        '''
+        Return True if the Expression commutes with the number operator of the given modes (names or Symbols), the sum of their a* a, or with the total number operator if no mode is given. Normal ordering keeps charges and only adds Terms, so this holds iff every Term has a zero total charge on these modes, which is read on the charge index without multiplying anything.
+        '''
+        names = set(m.name if isinstance(m, Symbol) else m for m in modes)
+
+        for charge in self.charge_index():
+            if sum(q for name, q in charge if not names or name in names):
+                return False
+
+        return True
+
+    def block(self, charge):
+        '''
+        Return the Expression made of the Terms of the given charge, a dict mapping mode names to their charges (missing modes having a zero charge).
+        '''
+        key = tuple(sorted((name, q) for name, q in charge.items() if q))
+        terms = []
+        for t, factor in self.charge_index().get(key, []):
+            terms.extend([t] * factor)
+
+        return Expression(terms, lazy=self._lazy)
+
+    def anti_normal_order(self):
+        '''
+        Return the anti-normal-ordered form of the Expression as an OrderedExpression.
+        '''
+        return OrderedExpression.from_expression(self).to_ordering('anti-normal')
+
+    def weyl_order(self):
+        '''
+        Return the Weyl-ordered (symmetrically ordered) form of the Expression as an OrderedExpression.
+        '''
+        return OrderedExpression.from_expression(self).to_ordering('weyl')
+
+    def iter_normal_ordered(self):
+        '''
+        Yield the normal-ordered form of the Expression as couples (Term, factor), one input Term after the other, without building the whole result. The same Term can thus be yielded several times, once for each input Term it comes from.
+        '''
+        memo = {}
+        for t, factor in self._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            if t.is_normal_ordered():
+                yield t, factor
+            else:
+                for u, g in groupby(self._normal_order_term(t, memo)): # The expansion is sorted, so equal Terms are adjacent
+                    yield u, factor * len(list(g))
+
+    def coefficient_of(self, term):
+        '''
+        Return the factor of the normal-ordered Term term in the normal-ordered form of the Expression, computed by counting contractions in each Term instead of normal ordering the Expression.
+        '''
+        if not term.is_normal_ordered():
+            raise Exception('Can only extract the coefficient of a normal-ordered Term.')
+
+        if ZERO in term.symbols:
+            return 0
+
+        target_scalars, target_words = term._mode_words()
+        res = 0
+
+        for t, factor in self._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            scalars, words = t._mode_words()
+            if scalars != target_scalars or not set(target_words) <= set(words):
+                continue
+
+            for mode, word in words.items():
+                target = target_words.get(mode, [])
+                k = sum(word) - sum(target) # Number of contractions needed for this mode
+                if k < 0 or len(word) - sum(word) - (len(target) - sum(target)) != k:
+                    break
+
+                factor *= self._contraction_counts(tuple(word))[k]
+                if not factor:
+                    break
+            else:
+                res += factor
+
+        return res
+
+    def vacuum_expectation(self):
+        '''
+        Return the vacuum expectation value of the Expression, which is the Expression of the scalar Terms of its normal-ordered form, computed by counting the complete contractions of each Term.
+        '''
+        terms = []
+
+        for t, factor in self._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            scalars, words = t._mode_words()
+            for word in words.values():
+                k = sum(word)
+                if len(word) != 2 * k:
+                    break
+
+                factor *= self._contraction_counts(tuple(word))[k]
+                if not factor:
+                    break
+            else:
+                terms.extend([Term(scalars)] * factor)
+
+        return Expression(terms)
+
+    @staticmethod
+    def _contraction_counts(word, _memo={}):
+        '''
+        Return the list whose k-th element is the number of ways to choose k disjoint contractions (an "a" followed, not necessarily directly, by an "a*") in the word of one mode, given as a tuple of dag attributes. The normal-ordered form of the word is the sum over k of these numbers times a*^(d - k) a^(n - k).
+        '''
+        if word in _memo:
+            return _memo[word]
+
+        states = {(0, 0): 1} # (annihilators waiting for their contraction, contractions done) -> number of ways
+        for dag in word:
+            new_states = {}
+            for (opened, k), ways in states.items():
+                new_states[(opened, k)] = new_states.get((opened, k), 0) + ways # Not contracted
+                if not dag:
+                    new_states[(opened + 1, k)] = new_states.get((opened + 1, k), 0) + ways
+                elif opened:
+                    new_states[(opened - 1, k + 1)] = new_states.get((opened - 1, k + 1), 0) + ways * opened
+            states = new_states
+
+        res = [0] * (len(word) // 2 + 1)
+        for (opened, k), ways in states.items():
+            if opened == 0:
+                res[k] += ways
+
+        _memo[word] = res
+
+        return res
+
+    @staticmethod
+    def _normal_order_term(t, memo=None):
+        '''
+        Return the list of normal-ordered Terms whose sum is equal to the Term t.
+
+        Only the operator word of t is normal-ordered, so that the result is shared by all scalar prefactors: it is looked up in the dict memo (Term -> list of Terms) and in Expression.cache (for long enough words) first when they are given, and stored in them.
+        '''
+        word = t._word_term()
+        res = None
+
+        if memo is not None:
+            res = memo.get(word)
+
+        cache = Expression.cache
+        if cache is not None and len(word.symbols) < cache.min_symbols:
+            cache = None
+
+        if res is None and cache is not None:
+            res = cache.get(word)
+            if res is not None and memo is not None:
+                memo[word] = res
+
+        if res is None:
+            symbols = word.symbols
+
+            j = word._disorder # symbols[j] is an "a" directly followed by an "a*"
+            t_before = Term(symbols[:j])
+            t_after = Term(symbols[j+2:])
+            t_inv = Term([symbols[j + 1], symbols[j]])
+
+            res = (t_before * Expression([t_inv, Term([ONE])]) * t_after).terms
+
+            if cache is not None:
+                cache.put(word, res)
+            if memo is not None:
+                memo[word] = res
+
+        if t.scalars:
+            scalars = Term._from_sorted(t.scalars)
+            res = [scalars * u for u in res]
+
+        return res
+
+    def _group_terms(self):
+        terms = self.terms
+        
+        res = []
+        i = 0
+        while i < len(terms):
+            t = terms[i]
+            j = 1
+            while i + j < len(terms) and terms[i + j] == t:
+                j += 1
+            
+            g = (t, j)
+            res.append(g)
+
+            i += j
+
+        return res
+
+class OrderedExpression:
+    '''
+    An OrderedExpression is a linear combination with rational coefficients of operator monomials in one ordering: 'normal' (a* before a), 'anti-normal' (a before a*) or 'weyl' (symmetric, written in braces). It has the attributes ordering and coefficients, a dict mapping the normal-ordered Term with the same Symbols as each monomial to its coefficient.
+
+    Orderings are converted mode by mode with the closed form
+        {a*^m a^n}_t = sum_k k! C(m, k) C(n, k) ((s - t) / 2)^k {a*^(m-k) a^(n-k)}_s
+    where t and s are 1, 0 and -1 for the normal, Weyl and anti-normal orderings, so that the cost is polynomial in the degrees of the Terms.
+    '''
+    _orderings = {'normal': 1, 'weyl': 0, 'anti-normal': -1}
+
+    def __init__(self, coefficients={}, ordering='normal'):
+        if ordering not in self._orderings:
+            raise Exception('Ordering "' + ordering + '" not implemented.')
+
+        self.ordering = ordering
+        self.coefficients = {}
+        for t, c in coefficients.items():
+            if not t.is_normal_ordered():
+                raise Exception('Monomials of an OrderedExpression are labelled by normal-ordered Terms.')
+            if c and ZERO not in t.symbols:
+                self.coefficients[t] = Fraction(c)
+
+    @classmethod
+    def from_expression(cls, expression):
+        '''
+        Return the normal-ordered form of the Expression expression as an OrderedExpression.
+        '''
+        return cls(dict(expression._normal_ordered()._group_terms()), 'normal')
+
+    def to_ordering(self, ordering):
+        '''
+        Return the same operator written in the given ordering.
+        '''
+        if ordering not in self._orderings:
+            raise Exception('Ordering "' + ordering + '" not implemented.')
+
+        x = Fraction(self._orderings[ordering] - self._orderings[self.ordering], 2)
+        res = {}
+
+        for t, c in self.coefficients.items():
+            scalars = [s for s in t.scalars if s.behavior != 'one']
+            expansions = [] # For each mode, the list of the Symbols and coefficients of the expansion
+
+            for mode, (_, length, mask) in t._modes.items():
+                if mode.behavior != 'annihilation':
+                    continue
+
+                m = bin(mask).count('1')
+                n = length - m
+                expansions.append([([mode.conj()] * (m - k) + [mode] * (n - k), factorial(k) * comb(m, k) * comb(n, k) * x ** k) for k in range(min(m, n) + 1) if x or not k])
+
+            for choice in product(*expansions):
+                symbols = list(scalars)
+                coef = c
+                for mode_symbols, mode_coef in choice:
+                    symbols.extend(mode_symbols)
+                    coef *= mode_coef
+
+                u = Term(symbols)
+                res[u] = res.get(u, 0) + coef
+
+        return OrderedExpression(res, ordering)
+
+    def to_expression(self):
+        '''
+        Return the normal-ordered form as an Expression, which requires nonnegative integer coefficients.
+        '''
+        normal = self.to_ordering('normal')
+
+        terms = []
+        for t, c in normal.coefficients.items():
+            if c < 0 or c.denominator != 1:
+                raise Exception('Expressions can only have nonnegative integer factors.')
+            terms.extend([t] * int(c))
+
+        return Expression(terms)
+
+    def __eq__(E, F):
+        return E.ordering == F.ordering and E.coefficients == F.coefficients
+
+    def __str__(self):
+        res = ''
+        for t in sorted(self.coefficients, reverse=True):
+            c = self.coefficients[t]
+            monomial = self._monomial_str(t)
+            s = (str(abs(c)) + ' ' if abs(c) != 1 else '') + (monomial if abs(c) == 1 or monomial != '1' else '')
+            if not res:
+                res = ('- ' if c < 0 else '') + s.strip()
+            else:
+                res += (' - ' if c < 0 else ' + ') + s.strip()
+
+        return res or '0'
+
+    def __repr__(self):
+        return "OrderedExpression('{}', '{}')".format(str(self), self.ordering)
+
+    def _monomial_str(self, t):
+        '''
+        Return the string of the monomial labelled by the normal-ordered Term t in the ordering of the OrderedExpression.
+        '''
+        if self.ordering == 'normal' or not t.word:
+            return str(t)
+
+        scalars = str(Term(t.scalars))
+        if self.ordering == 'anti-normal':
+            word = [s for s in t.word if not s.dag] + [s for s in t.word if s.dag] # The stable sort of Term keeps this order
+            operators = str(Term(word))
+        else:
+            operators = '{' + str(Term(t.word)) + '}'
+
+        return operators if scalars == '1' else scalars + ' ' + operators
+
+class HermitianExpression:
+    '''
+    A HermitianExpression is a normal-ordered Hermitian Expression stored as half of its Terms: pairs lists the couples (Term, factor) where the Term stands for itself plus its conjugate, the representative being the greater of the two, and selfadjoint lists those of the Terms equal to their conjugate. It can be instanciated like an Expression, and raises an Exception if the Expression is not Hermitian.
+
+    Normal ordering and squaring only work on the half: normal ordering commutes with conjugation, so the conjugate of a Term is never expanded, and the products x y and y* x* are conjugate, so only one product is computed per such couple. The full Expression is rebuilt on demand by expression().
+    '''
+    def __init__(self, info=[], bank=None):
+        if isinstance(info, str):
+            info = Expression(info, bank, lazy=True)
+        elif isinstance(info, list):
+            info = Expression(info, lazy=True)
+        elif not isinstance(info, Expression):
+            raise Exception('HermitianExpression constructor argument should be a string, a list of Terms or an Expression.')
+
+        halves = self._split(info._group_terms())
+        if halves is None and info._lazy:
+            halves = self._split(Expression(info.terms)._group_terms()) # Only Hermitian once normal-ordered
+        if halves is None:
+            raise Exception('Expression is not Hermitian.')
+
+        pairs = Counter()
+        selfadjoint = Counter()
+        for hermitian, groups in ((False, halves[0]), (True, halves[1])):
+            for t, factor in groups:
+                self._accumulate(pairs, selfadjoint, [t] if t.is_normal_ordered() else Expression._normal_order_term(t), factor, hermitian)
+
+        self._set(pairs, selfadjoint)
+
+    @staticmethod
+    def _split(groups):
+        '''
+        Return the couple (representatives of the pairs of conjugate Terms, self-adjoint Terms) of the couples (Term, factor) groups, or None if some Term and its conjugate do not have the same factor.
+        '''
+        factors = {t: factor for t, factor in groups if ZERO not in t.symbols}
+        pairs = []
+        selfadjoint = []
+
+        for t, factor in factors.items():
+            u = t.conj()
+            if u == t:
+                selfadjoint.append((t, factor))
+            elif factors.get(u) != factor:
+                return None
+            elif u < t:
+                pairs.append((t, factor))
+
+        return pairs, selfadjoint
+
+    @staticmethod
+    def _accumulate(pairs, selfadjoint, terms, factor, hermitian):
+        '''
+        Add factor times the normal-ordered Terms terms to the Counters pairs and selfadjoint. If hermitian is False the Terms stand for themselves plus their conjugates, otherwise their sum is Hermitian and only the representatives are counted.
+        '''
+        for t in terms:
+            u = t.conj()
+            if u == t:
+                selfadjoint[t] += factor if hermitian else 2 * factor
+            elif u < t:
+                pairs[t] += factor
+            elif not hermitian:
+                pairs[u] += factor
+
+    def _set(self, pairs, selfadjoint):
+        self.pairs = sorted(((t, c) for t, c in pairs.items() if c), reverse=True)
+        self.selfadjoint = sorted(((t, c) for t, c in selfadjoint.items() if c), reverse=True)
+        self._full = None
+
+    @classmethod
+    def _from_counts(cls, pairs, selfadjoint):
+        e = cls.__new__(cls)
+        e._set(pairs, selfadjoint)
+
+        return e
+
+    def expression(self):
+        '''
+        Return the full Expression, built once.
+        '''
+        if self._full is None:
+            terms = []
+            for t, factor in self.pairs:
+                terms.extend([t] * factor)
+                terms.extend([t.conj()] * factor)
+            for t, factor in self.selfadjoint:
+                terms.extend([t] * factor)
+
+            self._full = Expression(terms)
+
+        return self._full
+
+    def __eq__(E, F):
+        return E.pairs == F.pairs and E.selfadjoint == F.selfadjoint
+
+    def __str__(self):
+        return str(self.expression())
+
+    def __repr__(self):
+        return "HermitianExpression('{}')".format(str(self))
+
+    def __add__(E, F):
+        if not isinstance(F, HermitianExpression):
+            return NotImplemented
+
+        pairs = Counter(dict(E.pairs))
+        pairs.update(dict(F.pairs))
+        selfadjoint = Counter(dict(E.selfadjoint))
+        selfadjoint.update(dict(F.selfadjoint))
+
+        return HermitianExpression._from_counts(pairs, selfadjoint)
+
+    def square(self):
+        '''
+        Return the square of the HermitianExpression. The couples (x, y) of Terms are grouped in orbits of the involution (x, y) -> (y*, x*), and one product is normal-ordered per orbit.
+        '''
+        groups = [(t, c) for t, c in self.pairs] + [(t.conj(), c) for t, c in self.pairs] + self.selfadjoint
+        index = {t: i for i, (t, _) in enumerate(groups)}
+        conj_index = [index[t.conj()] for t, _ in groups]
+
+        pairs = Counter()
+        selfadjoint = Counter()
+        for i, (x, c) in enumerate(groups):
+            for j, (y, d) in enumerate(groups):
+                partner = (conj_index[j], conj_index[i])
+                if (i, j) > partner:
+                    continue # Obtained as the conjugate of the product of the partner
+
+                t = x * y
+                self._accumulate(pairs, selfadjoint, [t] if t.is_normal_ordered() else Expression._normal_order_term(t), c * d, (i, j) == partner)
+
+        return HermitianExpression._from_counts(pairs, selfadjoint)
+
+    def power(self, n):
+        '''
+        Return the n-th power of the HermitianExpression (n >= 1), by repeated squaring. Odd steps multiply full Expressions.
+        '''
+        if n < 1:
+            raise Exception('HermitianExpression powers start at 1.')
+        elif n == 1:
+            return self
+
+        res = self.power(n // 2).square()
+        if n % 2:
+            res = HermitianExpression(res.expression() * self.expression())
+
+        return res
+
+class _TemplateBank:
+    '''
+    Symbol bank used to parse the templates of an IndexedSum: names like "a_{i}" or "a_{i+1}" are placeholders for the members of the family a, the others are looked up in the wrapped SymbolBank.
+    '''
+    def __init__(self, bank):
+        self.bank = bank
+
+    def __getitem__(self, name):
+        slot = IndexedSum._slot_of_name(name)
+        if slot is None:
+            return self.bank[name]
+
+        family, var, offset = slot
+        base = self.bank[family]
+
+        return IndexedSum._placeholder(family, base.behavior, False, var, offset)
+
+class _Template:
+    '''
+    A Term of an IndexedSum. Its placeholders depend on the summation variables, each of which runs over the sites, under the constraints:
+        - var + offset is a site for each couple (var, offset) of members;
+        - v1 - v2 != d for each triple (v1, v2, d) of unequal, with v1 < v2.
+    '''
+    def __init__(self, term, variables, members, unequal):
+        self.term = term
+        self.variables = variables
+        self.members = members
+        self.unequal = unequal
+
+    def _key(self):
+        return (self.term, self.variables, self.members, self.unequal)
+
+    def __eq__(A, B):
+        return A._key() == B._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        res = 'sum_{' + ','.join(self.variables) + '} ' if self.variables else ''
+        res += str(self.term)
+
+        constraints = []
+        for v1, v2, d in sorted(self.unequal):
+            constraints.append('{} != {}'.format(v1, IndexedSum._index_str(v2, d)))
+        if constraints:
+            res += ' [' + ', '.join(constraints) + ']'
+
+        return res
+
+    def _renamed(self, renaming):
+        '''
+        Return the list of Symbols of the Template with its variables renamed, and the renamed constraints.
+        '''
+        symbols = [IndexedSum._rename(s, renaming) for s in self.term.symbols]
+        members = set((renaming.get(v, v), o) for v, o in self.members)
+        unequal = set(IndexedSum._normalize(renaming.get(v1, v1), renaming.get(v2, v2), d) for v1, v2, d in self.unequal)
+
+        return symbols, [renaming.get(v, v) for v in self.variables], members, unequal
+
+class IndexedSum:
+    '''
+    An IndexedSum is a lazy sum over lattice sites of Term templates, like
+        "a_{i}* a_{i+1} + a_{i+1}* a_{i}"
+    where "a_{i+1}" stands for the member of index i + 1 of the family of the Symbol a (see Symbol) and i runs over the sites. Members falling outside of the sites are dropped (open boundaries).
+
+    Products and normal ordering are done on the templates: when two placeholders of a same family may or may not be equal, the template is split into the case where they are (one variable is eliminated) and the case where they are not (an "!=" constraint is recorded). Concrete Terms are only produced by expand(), so the work scales with the number of templates and not with the number of sites.
+    '''
+    _placeholder_re = re.compile(r'^(.+)_\{([A-Za-z]\w*)([+-]\d+)?\}$')
+    _split_re = re.compile(r'\+(?![^{]*\})') # A '+' that is not inside braces
+    _var_names = ['i', 'j', 'k', 'l', 'm', 'p', 'q', 'r', 's']
+
+    def __init__(self, info, sites, bank=None):
+        self.sites = tuple(sites)
+        self._site_set = set(self.sites)
+
+        if isinstance(info, str):
+            bank = _TemplateBank(SymbolBank._coerce(bank))
+            templates = []
+
+            for i in self._split_re.split(info):
+                factor, i_info = Expression._parse_factor(i)
+                symbols = Term._parse(i_info, bank)
+
+                variables = []
+                members = set()
+                for s in symbols:
+                    slot = self._slot(s)
+                    if slot is not None:
+                        if slot[1] not in variables:
+                            variables.append(slot[1])
+                        members.add((slot[1], slot[2]))
+                members.update((v, 0) for v in variables) # Each variable runs over the sites
+
+                templates.extend(self._resolve(symbols, variables, members, set()) * factor)
+
+            self.templates = templates
+        elif isinstance(info, list):
+            self.templates = info
+        else:
+            raise Exception('IndexedSum constructor argument should be a string or a list of templates.')
+
+    def __add__(E, F):
+        F = E._coerce(F)
+        if F is NotImplemented:
+            return NotImplemented
+
+        return IndexedSum(E.templates + F.templates, E.sites)
+
+    def __radd__(E, F):
+        return E + F
+
+    def __mul__(E, F):
+        F = E._coerce(F)
+        if F is NotImplemented:
+            return NotImplemented
+
+        templates = []
+        for t in E.templates:
+            for u in F.templates:
+                templates.extend(E._multiply(t, u))
+
+        return IndexedSum(templates, E.sites)
+
+    def __rmul__(E, F):
+        F = E._coerce(F)
+        if F is NotImplemented:
+            return NotImplemented
+
+        return F * E
+
+    def __eq__(E, F):
+        return E.sites == F.sites and sorted(map(str, E.templates)) == sorted(map(str, F.templates))
+
+    def __str__(self):
+        groups = [(t, len(list(g))) for t, g in groupby(sorted(self.templates, key=str), key=str)]
+
+        return ' + '.join((str(c) + ' ' if c > 1 else '') + t for t, c in groups) if groups else '0'
+
+    def __repr__(self):
+        return "IndexedSum('{}', {})".format(str(self), self.sites)
+
+    def expand(self):
+        '''
+        Return the Expression of all the concrete Terms of the sum.
+        '''
+        terms = []
+
+        for t in self.templates:
+            for values in product(self.sites, repeat=len(t.variables)):
+                env = dict(zip(t.variables, values))
+
+                if not all(env[v] + o in self._site_set for v, o in t.members):
+                    continue
+                if not all(env[v1] - env[v2] != d for v1, v2, d in t.unequal):
+                    continue
+
+                symbols = []
+                for s in t.term.symbols:
+                    slot = self._slot(s)
+                    if slot is None:
+                        symbols.append(s)
+                    else:
+                        symbols.append(Symbol(slot[0], s.behavior, s.dag, env[slot[1]] + slot[2]))
+
+                terms.append(Term(symbols))
+
+        return Expression(terms)
+
+    def _coerce(self, F):
+        '''
+        Return F as an IndexedSum over the same sites, or NotImplemented.
+        '''
+        if isinstance(F, IndexedSum):
+            if F.sites != self.sites:
+                raise Exception('Cannot combine IndexedSums over different sites.')
+            return F
+        elif isinstance(F, Symbol):
+            F = Expression([Term([F])])
+        elif isinstance(F, Term):
+            F = Expression([F])
+
+        if isinstance(F, Expression):
+            return IndexedSum([_Template(t, (), frozenset(), frozenset()) for t in F.terms if t != Term('0')], self.sites)
+
+        return NotImplemented
+
+    def _multiply(self, t, u):
+        '''
+        Return the list of normal-ordered templates whose sum is the product of the templates t and u.
+        '''
+        taken = set(t.variables) | set(u.variables)
+        renaming = {}
+        for v in u.variables:
+            renaming[v] = self._fresh(taken)
+            taken.add(renaming[v])
+
+        t_symbols, t_variables, t_members, t_unequal = t._renamed({})
+        u_symbols, u_variables, u_members, u_unequal = u._renamed(renaming)
+
+        return self._resolve(t_symbols + u_symbols, t_variables + u_variables, t_members | u_members, t_unequal | u_unequal)
+
+    def _resolve(self, symbols, variables, members, unequal):
+        '''
+        Return the list of normal-ordered templates whose sum is the product of the Symbols in the written order, splitting the cases where two placeholders of a same mode family may coincide.
+        '''
+        slots = [self._slot(s) for s in symbols]
+
+        for p in range(len(symbols)):
+            for q in range(p + 1, len(symbols)):
+                s_p = symbols[p]
+                s_q = symbols[q]
+                if slots[p] is None or slots[q] is None or s_p.behavior != 'annihilation' or s_p.dag == s_q.dag or slots[p][0] != slots[q][0]:
+                    continue # These two commute whether they are on the same site or not
+
+                (_, v_p, o_p), (_, v_q, o_q) = slots[p], slots[q]
+                if v_p == v_q:
+                    continue # Same site iff same offset, already known
+
+                relation = self._normalize(v_p, v_q, o_q - o_p) # v_p + o_p = v_q + o_q iff v_p - v_q = o_q - o_p
+                if relation in unequal:
+                    continue
+
+                res = self._resolve(symbols, variables, members, unequal | {relation})
+
+                # Equal case: v2 = v1 - d
+                v1, v2, d = relation
+                renaming = {v2: (v1, -d)}
+                eq_symbols = [self._rename(s, renaming) for s in symbols]
+                eq_members = set((v1, o - d) if v == v2 else (v, o) for v, o in members)
+                eq_unequal = set()
+                for w1, w2, e in unequal:
+                    if w1 == v2:
+                        w1, e = v1, e + d # (v1 - d) - w2 != e
+                    if w2 == v2:
+                        w2, e = v1, e - d # w1 - (v1 - d) != e
+                    if w1 == w2:
+                        if e == 0:
+                            break # Contradiction, this case is empty
+                        continue # Always true
+                    eq_unequal.add(self._normalize(w1, w2, e))
+                else:
+                    res.extend(self._resolve(eq_symbols, [v for v in variables if v != v2], eq_members, eq_unequal))
+
+                return res
+
+        for s, slot in zip(symbols, slots):
+            if slot is None and s.index is not None and any(sl is not None and sl[0] == s.family for sl in slots):
+                raise Exception("Templates cannot mix placeholders and explicit members of the family '" + s.family + "'.")
+
+        # All the placeholders of a same family are now known to be on the same site or not, so the concrete normal ordering applies
+        variables = tuple(variables)
+        members = frozenset(members)
+        unequal = frozenset(unequal)
+
+        return [_Template(t, variables, members, unequal) for t in Expression([Term(symbols)]).terms if t != Term('0')]
+
+    @staticmethod
+    def _slot(symbol):
+        '''
+        Return the triple (family, variable, offset) of a placeholder Symbol, or None for any other Symbol.
+        '''
+        if '{' not in symbol.name:
+            return None
+
+        return IndexedSum._slot_of_name(symbol.name)
+
+    @staticmethod
+    def _slot_of_name(name):
+        m = IndexedSum._placeholder_re.match(name)
+        if m is None:
+            return None
+
+        return (m.group(1), m.group(2), int(m.group(3) or 0))
+
+    @staticmethod
+    def _placeholder(family, behavior, dag, var, offset):
+        return Symbol(family + '_{' + IndexedSum._index_str(var, offset) + '}', behavior, dag)
+
+    @staticmethod
+    def _index_str(var, offset):
+        return var + ('{:+d}'.format(offset) if offset else '')
+
+    @staticmethod
+    def _rename(symbol, renaming):
+        '''
+        Return the Symbol with the variable of its placeholder replaced, renaming mapping variables to new variables or to couples (variable, shift).
+        '''
+        slot = IndexedSum._slot(symbol)
+        if slot is None or slot[1] not in renaming:
+            return symbol
+
+        family, var, offset = slot
+        new = renaming[var]
+        if isinstance(new, tuple):
+            var, offset = new[0], offset + new[1]
+        else:
+            var = new
+
+        return IndexedSum._placeholder(family, symbol.behavior, symbol.dag, var, offset)
+
+    @staticmethod
+    def _normalize(v1, v2, d):
+        return (v1, v2, d) if v1 < v2 else (v2, v1, -d)
+
+    def _fresh(self, taken):
+        for v in self._var_names:
+            if v not in taken:
+                return v
+
+        n = 1
+        while True:
+            for v in self._var_names:
+                if v + str(n) not in taken:
+                    return v + str(n)
+            n += 1
+
+class ExpressionGraph:
+    '''
+    An ExpressionGraph records sums, products and conjugates of Expressions as Deferred nodes instead of computing them. Nodes are interned by their structure (the operation and the nodes it applies to, sums being commutative), so that building the same intermediate result twice, e.g. H * A used in several commutators, gives the same node, which is evaluated at most once.
+
+    Leaves are created by leaf(); arithmetic between a Deferred node and Expressions, Terms, Symbols or strings then records new nodes of the same graph. Arithmetic between plain Expressions stays eager, so a derivation is recorded by wrapping its input Expressions once with leaf(), the rest of the code being unchanged since Deferred nodes support +, *, conj() and commutator() and expose terms and str like an Expression.
+    '''
+    def __init__(self, bank=None):
+        self.bank = bank
+        self._nodes = {} # Structural key -> Deferred
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def leaf(self, info):
+        '''
+        Return the node of the normal-ordered Expression info, which can also be a Term, a Symbol or a string.
+        '''
+        if isinstance(info, Deferred):
+            if info.graph is not self:
+                raise Exception('Cannot mix nodes of different ExpressionGraphs.')
+            return info
+        elif isinstance(info, Symbol):
+            expression = Expression([Term([info])])
+        elif isinstance(info, Term):
+            expression = Expression([info])
+        elif isinstance(info, str):
+            expression = Expression(info, self.bank)
+        elif isinstance(info, Expression):
+            expression = Expression(info.terms)
+        else:
+            raise Exception('Cannot record a ' + type(info).__name__ + ' in an ExpressionGraph.')
+
+        node = self._node(('leaf', tuple(expression.terms)))
+        if node._value is None:
+            node._value = expression
+
+        return node
+
+    def _node(self, key):
+        if key not in self._nodes:
+            self._nodes[key] = Deferred(self, key, len(self._nodes))
+
+        return self._nodes[key]
+
+class Deferred:
+    '''
+    A Deferred is a node of an ExpressionGraph standing for an Expression that is only computed by evaluate(), once, the result being memoized along with those of all the nodes it depends on. Its Terms and its string are those of the evaluated Expression, so that it can be used in place of an Expression.
+
+    Nodes are compared by identity, which is structural equality thanks to the interning.
+    '''
+    def __init__(self, graph, key, serial):
+        self.graph = graph
+        self.op = key[0]
+        self.children = key[1:] if self.op != 'leaf' else ()
+        self._serial = serial
+        self._value = None
+
+    def _operand(E, F):
+        '''
+        Return F as a node of the graph of E, or None if F is of a type that cannot be recorded. Invalid strings and nodes of other graphs still raise their Exception.
+        '''
+        if not isinstance(F, (Deferred, Symbol, Term, str, Expression)):
+            return None
+
+        return E.graph.leaf(F)
+
+    def __add__(E, F):
+        F = E._operand(F)
+        if F is None:
+            return NotImplemented
+
+        return E.graph._node(('add',) + tuple(sorted((E, F), key=lambda x: x._serial)))
+
+    def __radd__(E, F):
+        return E + F
+
+    def __mul__(E, F):
+        F = E._operand(F)
+        if F is None:
+            return NotImplemented
+
+        return E.graph._node(('mul', E, F))
+
+    def __rmul__(E, F):
+        F = E._operand(F)
+        if F is None:
+            return NotImplemented
+
+        return E.graph._node(('mul', F, E))
+
+    def conj(self):
+        return self.graph._node(('conj', self))
+
+    def commutator(E, F):
+        '''
+        Return the couple of Expressions (P, N) of Expression.commutator, the products E F and F E being nodes of the graph.
+        '''
+        F = E.graph.leaf(F)
+
+        return Expression._cancelled((E * F).evaluate(), (F * E).evaluate())
+
+    @property
+    def terms(self):
+        return self.evaluate().terms
+
+    def __str__(self):
+        return str(self.evaluate())
+
+    def __repr__(self):
+        return "Deferred('{}', {} children)".format(self.op, len(self.children))
+
+    def evaluate(self):
+        '''
+        Return the normal-ordered Expression of the node, evaluating first the nodes it depends on that have not been evaluated yet.
+        '''
+        stack = [self] # Explicit stack, since long derivations make deep graphs
+        while stack:
+            node = stack[-1]
+            if node._value is not None:
+                stack.pop()
+                continue
+
+            pending = [c for c in node.children if c._value is None]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            values = [c._value for c in node.children]
+            if node.op == 'add':
+                node._value = values[0]._merge(values[1]) # Both are sorted already
+            elif node.op == 'mul':
+                node._value = values[0] * values[1]
+            else:
+                node._value = values[0].conj()
+
+        return self._value
+
+class CoherentEvaluator:
+    '''
+    A CoherentEvaluator evaluates a normal-ordered Expression in coherent states, every annihilation Symbol a being replaced by its eigenvalue alpha and a* by conj(alpha), over whole arrays of values at once.
+
+    The monomial exponent table (one row per Term, one column per Symbol name, split between plain and dagged powers) is computed once at instanciation from the grouped Symbols of the Terms.
+    '''
+    _evaluated_behaviors = ['real', 'complex', 'annihilation']
+
+    def __init__(self, expression):
+        try:
+            import numpy as np # Imported here so that loading the module does not pay for numpy
+        except ImportError:
+            raise Exception('CoherentEvaluator requires numpy.')
+
+        groups = [(t, c) for t, c in expression._normal_ordered()._group_terms() if ZERO not in t.symbols]
+
+        names = []
+        for t, _ in groups:
+            for s in t.symbols:
+                if s.behavior in self._evaluated_behaviors and s.name not in names:
+                    names.append(s.name)
+
+        self.names = names
+        self.coefs = np.array([c for _, c in groups], dtype=float)
+        self.exponents = np.zeros((len(groups), len(names), 2), dtype=int) # Last axis: power of the Symbol, power of its conjugate
+
+        for i, (t, _) in enumerate(groups):
+            for s, p in t._group_symbols():
+                if s.behavior in self._evaluated_behaviors:
+                    self.exponents[i, names.index(s.name), int(s.dag)] += p
+
+    def __call__(self, values):
+        '''
+        Return the array of the values of the Expression, values mapping each Symbol name to a number or an array (all arrays being broadcast together).
+        '''
+        import numpy as np
+
+        for name in self.names:
+            if name not in values:
+                raise Exception("No value given for symbol '" + name + "'.")
+
+        arrays = np.broadcast_arrays(*[np.asarray(values[name], dtype=complex) for name in self.names]) if self.names else []
+        shape = arrays[0].shape if arrays else ()
+
+        monomials = np.ones((len(self.coefs),) + shape, dtype=complex)
+
+        for j, x in enumerate(arrays):
+            for dag in (0, 1):
+                exponents = self.exponents[:, j, dag]
+                max_pow = exponents.max() if len(exponents) else 0
+                if max_pow == 0:
+                    continue
+
+                base = np.conj(x) if dag else x
+                powers = np.empty((max_pow + 1,) + shape, dtype=complex) # Every power is computed once for all the Terms
+                powers[0] = 1
+                for k in range(1, max_pow + 1):
+                    powers[k] = powers[k - 1] * base
+
+                monomials *= powers[exponents]
+
+        return np.tensordot(self.coefs, monomials, axes=1)
+
+class IncrementalPower:
+    '''
+    An IncrementalPower keeps the normal-ordered powers H, H^2, ..., H^n of an Expression H so that they can be updated when a few Terms are added to H or removed from it, instead of being recomputed from scratch.
+
+    Writing H' = H + D the updated Expression and H'^k = H^k + D_k, the differences satisfy D_1 = D and D_k = H^(k-1) D + D_(k-1) H', so that an update only multiplies the stored powers by the difference. Since Expressions only have positive factors, differences are kept as couples (P, N) of Expressions standing for P - N.
+    '''
+    def __init__(self, expression, n=2):
+        if n < 1:
+            raise Exception('The exponent of an IncrementalPower should be at least 1.')
+
+        expression = self._coerce(expression)
+
+        self.n = n
+        self.powers = [expression]
+        for k in range(1, n):
+            self.powers.append(self.powers[-1] * expression)
+
+    @property
+    def expression(self):
+        return self.powers[0]
+
+    def __getitem__(self, k):
+        if not 1 <= k <= self.n:
+            raise Exception('IncrementalPower only keeps the powers 1 to {}.'.format(self.n))
+
+        return self.powers[k - 1]
+
+    def update(self, added=None, removed=None):
+        '''
+        Add the Terms of added to the Expression, remove those of removed (each of them can be an Expression, a Term or a string) and update all the powers.
+        '''
+        added = self._coerce(added)
+        removed = self._coerce(removed)
+
+        new_expression = self._apply(self.powers[0], added, removed)
+        p, m = added, removed
+        powers = [new_expression]
+
+        for k in range(1, self.n):
+            p, m = (self.powers[k - 1] * added)._merge(p * new_expression), (self.powers[k - 1] * removed)._merge(m * new_expression)
+            powers.append(self._apply(self.powers[k], p, m))
+
+        self.powers = powers
+
+    @staticmethod
+    def _apply(E, P, N):
+        '''
+        Return the normal-ordered Expression E + P - N, the three of them being normal-ordered. The sorted Terms of P and N are merged into those of E by galloping from one insertion point to the next, so that the number of Term comparisons is driven by the size of the difference rather than by that of E.
+        '''
+        terms = [t for t in E.terms if ZERO not in t.symbols]
+
+        res = []
+        i = 0
+        for t in P.terms:
+            if ZERO not in t.symbols:
+                k = IncrementalPower._gallop(terms, i, lambda u: u == t or not u < t) # Equal Terms stay together
+                res.extend(terms[i:k])
+                res.append(t)
+                i = k
+        res.extend(terms[i:])
+
+        terms = res
+        res = []
+        i = 0
+        for t in N.terms:
+            if ZERO not in t.symbols:
+                k = IncrementalPower._gallop(terms, i, lambda u: u != t and t < u)
+                if k == len(terms) or terms[k] != t:
+                    raise Exception('Cannot remove Terms that are not in the Expression.')
+                res.extend(terms[i:k])
+                i = k + 1
+        res.extend(terms[i:])
+
+        return Expression._from_sorted(res)
+
+    @staticmethod
+    def _gallop(terms, lo, before):
+        '''
+        Return the index of the first Term of terms from lo on for which before is False, before being True on an initial segment of terms.
+        '''
+        step = 1
+        hi = lo
+        while hi < len(terms) and before(terms[hi]):
+            lo = hi + 1
+            hi = lo + step
+            step *= 2
+
+        hi = min(hi, len(terms))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if before(terms[mid]):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    @staticmethod
+    def _coerce(info):
+        '''
+        Return info as a normal-ordered Expression.
+        '''
+        if info is None:
+            return Expression()
+        elif isinstance(info, Expression):
+            return Expression(info.terms)
+        elif isinstance(info, Term):
+            return Expression([info])
+        elif isinstance(info, str):
+            return Expression(info)
+        else:
+            raise Exception('Cannot update with a ' + type(info).__name__ + '.')
+
+class IncrementalCommutator:
+    '''
+    An IncrementalCommutator keeps the commutator of an Expression E with a fixed Expression F, as the couple (P, N) returned by Expression.commutator, and updates it when a few Terms are added to E or removed from it: adding D to E adds D F to P and F D to N, and removing it does the opposite.
+    '''
+    def __init__(self, expression, other):
+        self.expression = IncrementalPower._coerce(expression)
+        self.other = IncrementalPower._coerce(other)
+        self.P, self.N = self.expression.commutator(self.other)
+
+    def update(self, added=None, removed=None):
+        '''
+        Add the Terms of added to E, remove those of removed and update the commutator.
+        '''
+        added = IncrementalPower._coerce(added)
+        removed = IncrementalPower._coerce(removed)
+        F = self.other
+
+        self.expression = IncrementalPower._apply(self.expression, added, removed)
+
+        self.P, self.N = Expression._cancelled(self.P + added * F + F * removed, self.N + F * added + removed * F)
+
+class DiskExpression:
+    '''
+    A DiskExpression is a normal-ordered Expression too large for memory. Added Terms are normal-ordered and counted in a buffer of at most run_size distinct Terms, which is written to the directory as a sorted run file whenever it is full; iterating merges the runs (and the buffer) with an external k-way merge in the decreasing order of Terms, adding up the factors of equal Terms. Runs are merged into one as soon as there are more than max_runs of them.
+
+    Products with Expressions, Terms and other DiskExpressions are streamed into new DiskExpressions. The files are deleted by close(), or at the end of a with block.
+    '''
+    def __init__(self, directory=None, run_size=100000, max_runs=16):
+        self._own_directory = directory is None
+        self.directory = tempfile.mkdtemp(prefix='orderer-') if directory is None else directory
+        self.run_size = run_size
+        self.max_runs = max_runs
+
+        self._buffer = {} # Term -> factor
+        self._runs = [] # Paths of the run files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, term, factor=1):
+        '''
+        Add factor times the normal-ordered form of the Term term.
+        '''
+        if ZERO in term.symbols:
+            return
+
+        for t in ([term] if term.is_normal_ordered() else Expression._normal_order_term(term)):
+            self._buffer[t] = self._buffer.get(t, 0) + factor
+
+            if len(self._buffer) >= self.run_size:
+                self._flush()
+
+    def extend(self, terms):
+        '''
+        Add every Term of terms (an iterable of Terms, an Expression or a DiskExpression).
+        '''
+        if isinstance(terms, (Expression, DiskExpression)):
+            for t, factor in terms._group_terms():
+                self.add(t, factor)
+        else:
+            for t in terms:
+                self.add(t)
+
+    def __iter__(self):
+        '''
+        Yield the Terms of the DiskExpression in decreasing order, with repetitions.
+        '''
+        for t, factor in self._group_terms():
+            for _ in range(factor):
+                yield t
+
+    def _group_terms(self):
+        '''
+        Yield the couples (Term, factor) of the DiskExpression in decreasing order of Terms, reading the runs lazily.
+        '''
+        buffer = sorted(self._buffer.items(), key=lambda g: g[0], reverse=True)
+        merged = heapq.merge(*[self._read_run(path) for path in self._runs], iter(buffer), key=lambda g: g[0], reverse=True)
+
+        for t, g in groupby(merged, key=lambda g: g[0]):
+            factor = sum(f for _, f in g)
+            if factor:
+                yield t, factor
+
+    def __mul__(E, F):
+        if isinstance(F, Symbol):
+            F = Term([F])
+        if isinstance(F, Term):
+            F = Expression([F])
+        if not isinstance(F, (Expression, DiskExpression)):
+            return NotImplemented
+
+        groups = F._group_terms() if isinstance(F, Expression) else None # A DiskExpression is read again for each Term
+
+        res = E._sibling()
+        for t, factor in E._group_terms():
+            for u, g in (groups if groups is not None else F._group_terms()):
+                res.add(t * u, factor * g)
+
+        return res
+
+    def __rmul__(E, F):
+        if isinstance(F, Symbol):
+            F = Term([F])
+        if isinstance(F, Term):
+            F = Expression([F])
+        if not isinstance(F, Expression):
+            return NotImplemented
+
+        res = E._sibling()
+        for u, g in F._group_terms():
+            for t, factor in E._group_terms():
+                res.add(u * t, factor * g)
+
+        return res
+
+    def to_expression(self):
+        '''
+        Return the DiskExpression as an Expression, loading all its Terms in memory.
+        '''
+        return Expression._from_sorted(list(self))
+
+    def close(self):
+        '''
+        Delete the run files (and the directory if it was created by the DiskExpression).
+        '''
+        for path in self._runs:
+            os.remove(path)
+        self._runs = []
+        self._buffer = {}
+
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _sibling(self):
+        return DiskExpression(self.directory if not self._own_directory else None, self.run_size, self.max_runs)
+
+    def _flush(self):
+        '''
+        Write the buffer as a new run, then merge all the runs into one if there are too many of them.
+        '''
+        if self._buffer:
+            groups = sorted(self._buffer.items(), key=lambda g: g[0], reverse=True)
+            self._runs.append(self._write_run(groups))
+            self._buffer = {}
+
+        if len(self._runs) > self.max_runs:
+            runs = self._runs
+            self._runs = [self._write_run(self._group_terms())] # The buffer is empty here
+            for path in runs:
+                os.remove(path)
+
+    def _write_run(self, groups):
+        fd, path = tempfile.mkstemp(prefix='run-', suffix='.txt', dir=self.directory)
+
+        with os.fdopen(fd, 'w') as f:
+            for t, factor in groups:
+                f.write('{} {}\n'.format(factor, t._encode()))
+
+        return path
+
+    @staticmethod
+    def _read_run(path):
+        with open(path) as f:
+            for line in f:
+                factor, code = line.rstrip('\n').split(' ', 1)
+                yield Term._decode(code), int(factor)
+
+class NormalOrderPlanner:
+    '''
+    A NormalOrderPlanner estimates the cost of normal ordering an Expression before doing it, then chooses how to do it.
+
+    The estimate counts, mode by mode, the contractions of each operator word with Expression._contraction_counts, without any rewriting: a Term gives the product over its modes of the numbers of contractions, with repetitions, and work is that number times the length of the word. The engines are 'rewrite' (Expression.normal_order, which shares the expansions of the operator words within one call) for small inputs, 'cached' (the same with a memo of the expanded operator words owned by the planner and kept between calls, cleared when it reaches max_entries) above small_work, and 'parallel' (normal_order_many on a process pool owned by the planner, created at its first use and shut down by close()) above parallel_work. Inputs whose work exceeds budget are refused.
+    '''
+    def __init__(self, budget=10**7, small_work=10**3, parallel_work=10**5, processes=0, max_entries=100000):
+        self.budget = budget
+        self.small_work = small_work
+        self.parallel_work = parallel_work
+        self.processes = processes # None disables the parallel engine, 0 means one process per CPU
+        self.max_entries = max_entries
+
+        self._memo = {} # Operator word -> list of normal-ordered Terms, for the 'cached' engine
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def estimate(self, expression):
+        '''
+        Return a dict with the estimated number of normal-ordered Terms (terms, with repetitions, and distinct_terms, bounded above by the number of distinct contraction counts), and the estimated work.
+        '''
+        terms = 0
+        distinct_terms = 0
+        work = 0
+
+        for t, factor in expression._group_terms():
+            if ZERO in t.symbols:
+                continue
+
+            _, words = t._mode_words()
+            num = factor
+            num_distinct = 1
+            for word in words.values():
+                counts = Expression._contraction_counts(tuple(word))
+                num *= sum(counts)
+                num_distinct *= sum(1 for c in counts if c)
+
+            terms += num
+            distinct_terms += num_distinct
+            work += num * max(1, len(t.word))
+
+        return {'terms': terms, 'distinct_terms': distinct_terms, 'work': work}
+
+    def plan(self, expression):
+        '''
+        Return the estimate of expression completed with the chosen engine, or raise an Exception if its work exceeds the budget.
+        '''
+        res = self.estimate(expression)
+
+        if res['work'] > self.budget:
+            raise Exception('Normal ordering would take about {} operations, above the budget of {}.'.format(res['work'], self.budget))
+        elif res['work'] > self.parallel_work and self.processes is not None:
+            res['engine'] = 'parallel'
+        elif res['work'] > self.small_work:
+            res['engine'] = 'cached'
+        else:
+            res['engine'] = 'rewrite'
+
+        return res
+
+    def normal_order(self, expression):
+        '''
+        Return the normal-ordered form of expression (an Expression or a string, parsed lazily) with the engine chosen by plan().
+        '''
+        if isinstance(expression, str):
+            expression = Expression(expression, lazy=True)
+
+        engine = self.plan(expression)['engine']
+
+        if engine == 'parallel':
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.processes or None)
+            return normal_order_many([expression], processes=self.processes, executor=self._executor)[0]
+        elif engine == 'cached':
+            if len(self._memo) >= self.max_entries:
+                self._memo.clear()
+            terms = []
+            for t, factor in expression._group_terms():
+                terms.extend(([t] if t.is_normal_ordered() else Expression._normal_order_term(t, self._memo)) * factor)
+            return Expression(terms)
+        else:
+            return Expression(expression.terms)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+class NormalOrderCache:
+    '''
+    A NormalOrderCache stores the normal-ordered expansions of Terms in an SQLite file so that they can be reused across runs and processes. Entries are keyed by the canonical encoding of the Term and by the library version, and the least recently used ones are evicted beyond max_entries.
+
+    Set Expression.cache to an instance to make normal_order() consult it for operator words of at least min_symbols Symbols (shorter ones are cheaper to expand than to look up). Entries read once are also kept in memory, and their last use times are written to the file in batches, so that hits do not take the write lock. An instance can be shared between threads.
+    '''
+    _prune_every = 100 # Number of insertions between two automatic prunings
+    _touch_every = 100 # Number of hits between two writings of the last use times
+
+    def __init__(self, path, max_entries=100000, timeout=30, min_symbols=4):
+        self.path = path
+        self.max_entries = max_entries
+        self.min_symbols = min_symbols
+        self._puts = 0
+        self._memory = {} # Key -> list of Terms, entries never change for a given version
+        self._touched = {} # Key -> last use time not written yet
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False) # Autocommit, transactions are opened explicitly
+        self._conn.execute('PRAGMA journal_mode=WAL') # Readers and the writer of different processes do not block each other
+        self._conn.execute('CREATE TABLE IF NOT EXISTS terms (key TEXT, version TEXT, result TEXT, used REAL, PRIMARY KEY (key, version))')
+
+    def get(self, term):
+        '''
+        Return the list of normal-ordered Terms equal to term, or None if it is not cached.
+        '''
+        key = term._encode()
+
+        with self._lock:
+            res = self._memory.get(key)
+
+            if res is None:
+                row = self._conn.execute('SELECT result FROM terms WHERE key = ? AND version = ?', (key, __version__)).fetchone()
+                if row is None:
+                    return None
+
+                res = []
+                for code, factor in json.loads(row[0]):
+                    res.extend([Term._decode(code)] * factor)
+                self._remember(key, res)
+
+            self._touched[key] = time.time()
+            if len(self._touched) >= self._touch_every:
+                self._touch()
+
+        return list(res)
+
+    def put(self, term, terms):
+        '''
+        Store the list of normal-ordered Terms equal to term.
+        '''
+        key = term._encode()
+        result = json.dumps([[t._encode(), len(list(g))] for t, g in groupby(terms)]) # terms are sorted, so equal Terms are adjacent
+
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO terms VALUES (?, ?, ?, ?)', (key, __version__, result, time.time()))
+            self._remember(key, list(terms))
+            self._touched.pop(key, None)
+            self._puts += 1
+
+        if self._puts % self._prune_every == 0:
+            self.prune()
+
+    def _remember(self, key, terms):
+        if len(self._memory) >= self.max_entries:
+            self._memory.clear()
+        self._memory[key] = terms
+
+    def _touch(self):
+        '''
+        Write the pending last use times in one transaction. The lock must be held.
+        '''
+        if not self._touched:
+            return
+
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._conn.executemany('UPDATE terms SET used = ? WHERE key = ? AND version = ?', [(used, key, __version__) for key, used in self._touched.items()])
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+        self._conn.execute('COMMIT')
+        self._touched.clear()
+
+    def prune(self, max_entries=None, all_versions=False):
+        '''
+        Delete the entries of other library versions (or every entry if all_versions is True), then the least recently used entries beyond max_entries (self.max_entries by default). Return the number of deleted entries.
+        '''
+        if max_entries is None:
+            max_entries = self.max_entries
+
+        with self._lock:
+            self._touch()
+            self._memory.clear()
+
+            return self._prune(max_entries, all_versions)
+
+    def _prune(self, max_entries, all_versions):
+        self._conn.execute('BEGIN IMMEDIATE') # Take the write lock so that concurrent prunings do not interleave
+        try:
+            if all_versions:
+                deleted = self._conn.execute('DELETE FROM terms').rowcount
+            else:
+                deleted = self._conn.execute('DELETE FROM terms WHERE version != ?', (__version__,)).rowcount
+
+            count = self._conn.execute('SELECT COUNT(*) FROM terms').fetchone()[0]
+            if count > max_entries:
+                deleted += self._conn.execute('DELETE FROM terms WHERE rowid IN (SELECT rowid FROM terms ORDER BY used LIMIT ?)', (count - max_entries,)).rowcount
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+        self._conn.execute('COMMIT')
+
+        return deleted
+
+    def info(self):
+        '''
+        Return a dict describing the content of the cache.
+        '''
+        with self._lock:
+            versions = dict(self._conn.execute('SELECT version, COUNT(*) FROM terms GROUP BY version').fetchall())
+
+        return {'path': self.path, 'entries': sum(versions.values()), 'versions': versions, 'max_entries': self.max_entries, 'bytes': os.path.getsize(self.path)}
+
+    def close(self):
+        with self._lock:
+            self._touch()
+            self._conn.close()
+
+class NormalOrderServer:
+    '''
+    A NormalOrderServer keeps a warm normal-ordering engine in one long-lived process and serves it over a Unix socket (path) or a localhost TCP port.
+
+    The protocol is line-based: each request is an Expression string in the format of Expression.__str__ and each answer is the string of its normal-ordered form, or "error: <message>". Requests arriving within batch_delay seconds of each other, possibly from different clients or pipelined on one connection, are processed together so that each distinct Term of the batch is normal-ordered once. Batches run one at a time in a worker thread, so that the event loop keeps reading requests meanwhile. Parsed Terms and normal-ordered Terms are kept in memory between requests, each of these two memos being cleared when it reaches max_entries.
+    '''
+    def __init__(self, path=None, host='127.0.0.1', port=0, bank=None, batch_delay=0.005, max_entries=100000):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.bank = SymbolBank._coerce(bank)
+        self.batch_delay = batch_delay
+        self.max_entries = max_entries
+
+        self._parsed = {} # Term string -> Term
+        self._ordered = {} # Operator word -> list of normal-ordered Terms
+        self._pending = [] # Couples (request, future) waiting for the next batch
+        self._batches = set() # Running batch tasks
+        self._executor = None
+        self._loop = None
+        self._stop = None
+        self.ready = threading.Event()
+
+    def serve_forever(self):
+        '''
+        Serve until shutdown() is called (from any thread).
+        '''
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+
+        if self.path is not None:
+            server = await asyncio.start_unix_server(self._handle, self.path)
+        else:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = server.sockets[0].getsockname()[1] # The actual port when 0 was asked
+
+        self._executor = ThreadPoolExecutor(max_workers=1) # One batch at a time, since the batches share _parsed and _ordered
+        self.ready.set()
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def _handle(self, reader, writer):
+        answers = asyncio.Queue() # Futures of the answers in the order of the requests, None at the end
+        writing = self._loop.create_task(self._write(answers, writer))
+
+        try:
+            while True:
+                line = await reader.readline() # Pipelined requests are all read before their answers come
+                if not line:
+                    break
+
+                future = self._loop.create_future()
+                if not self._pending:
+                    self._loop.call_later(self.batch_delay, self._flush)
+                self._pending.append((line.decode().strip(), future))
+                answers.put_nowait(future)
+        finally:
+            answers.put_nowait(None)
+            await writing
+            writer.close()
+
+    async def _write(self, answers, writer):
+        while True:
+            future = await answers.get()
+            if future is None:
+                break
+
+            try:
+                answer = await future
+            except Exception as e:
+                answer = 'error: ' + str(e)
+
+            try:
+                writer.write(answer.encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass # The client left, its remaining answers are dropped
+
+    def _flush(self):
+        batch = self._pending
+        self._pending = []
+
+        task = self._loop.create_task(self._run(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch):
+        try:
+            answers = await self._loop.run_in_executor(self._executor, self.normal_order_batch, [request for request, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), answer in zip(batch, answers):
+            future.set_result(answer)
+
+    def normal_order_batch(self, infos):
+        '''
+        Return the list of the strings of the normal-ordered forms of the Expression strings infos, normal ordering each distinct Term only once.
+        '''
+        if len(self._ordered) >= self.max_entries:
+            self._ordered.clear() # Checked between batches, since a batch fills the memo while it runs
+
+        parsed = []
+        for info in infos:
+            try:
+                parsed.append(self._parse(info))
+            except Exception as e:
+                parsed.append(e)
+
+        res = []
+        for terms in parsed:
+            if isinstance(terms, Exception):
+                res.append('error: ' + str(terms))
+                continue
+
+            ordered = []
+            for t in terms:
+                ordered.extend(Expression._normal_order_term(t, self._ordered) if not t.is_normal_ordered() else [t]) # Each operator word is expanded once for the whole batch
+            res.append(str(Expression(ordered)))
+
+        return res
+
+    def _parse(self, info):
+        '''
+        Return the list of the Terms of an Expression string (with repetitions), without normal ordering them.
+        '''
+        terms = []
+        if not info:
+            return terms
+
+        for i in info.split('+'):
+            factor, t_info = Expression._parse_factor(i)
+            if t_info not in self._parsed:
+                if len(self._parsed) >= self.max_entries:
+                    self._parsed.clear()
+                self._parsed[t_info] = Term(t_info, self.bank)
+            terms.extend([self._parsed[t_info]] * factor)
+
+        return terms
+
+class NormalOrderClient:
+    '''
+    A NormalOrderClient sends Expressions to a NormalOrderServer and returns their normal-ordered forms.
+    '''
+    def __init__(self, path=None, host='127.0.0.1', port=None, bank=None, timeout=None):
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port), timeout=timeout)
+
+        self._file = self._sock.makefile('rwb')
+        self.bank = bank
+
+    def normal_order(self, expression):
+        '''
+        Return the normal-ordered form of expression, an Expression or its string.
+        '''
+        return self.normal_order_many([expression])[0]
+
+    def normal_order_many(self, expressions):
+        '''
+        Return the list of the normal-ordered forms of the Expressions (or strings) sent together in one round trip.
+        '''
+        for e in expressions:
+            self._file.write(str(e).encode() + b'\n')
+        self._file.flush()
+
+        res = []
+        for _ in expressions:
+            answer = self._file.readline().decode().strip()
+            if answer.startswith('error: '):
+                raise Exception(answer[len('error: '):])
+            res.append(Expression(answer, self.bank))
+
+        return res
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+def normal_order_many(expressions, processes=None, bank=None, executor=None):
+    '''
+    Return the list of the normal-ordered forms of expressions (Expressions or strings), in the same order.
+
+    The distinct disordered operator words of the whole batch are collected first and each of them is normal-ordered once, by a pool of processes (processes of them, or one per CPU if it is 0) unless processes is None, before every Expression is reassembled from the shared results. An existing ProcessPoolExecutor can be given as executor instead of starting a new pool.
+    '''
+    bank = SymbolBank._coerce(bank) # Converted once for all the strings
+    groups = []
+    words = {} # Operator word -> None, in order of appearance
+
+    for e in expressions:
+        if isinstance(e, str):
+            e = Expression(e, bank, lazy=True)
+        elif not isinstance(e, Expression):
+            raise Exception('Cannot normal-order a ' + type(e).__name__ + '.')
+
+        g = e._group_terms()
+        groups.append(g)
+        for t, _ in g:
+            if not t.is_normal_ordered():
+                words.setdefault(t._word_term())
+
+    memo = {}
+    if processes is None and executor is None:
+        for word in words:
+            Expression._normal_order_term(word, memo)
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(processes or None)
+
+        try:
+            codes = [word._encode() for word in words]
+            for word, res in zip(words, executor.map(_normal_order_word, codes, chunksize=max(1, len(codes) // (4 * (processes or os.cpu_count() or 1))))):
+                memo[word] = [Term._decode(code) for code, factor in res for _ in range(factor)]
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    res = []
+    for g in groups:
+        terms = []
+        for t, factor in g:
+            terms.extend(([t] if t.is_normal_ordered() else Expression._normal_order_term(t, memo)) * factor)
+        res.append(Expression(terms))
+
+    return res
+
+def _normal_order_word(code):
+    '''
+    Worker of normal_order_many: return the normal-ordered form of the encoded operator word code as a list of couples (Term encoding, factor).
+    '''
+    Expression.cache = None # The connection of the parent process must not be used after a fork, the parent stores the results
+
+    return [(t._encode(), len(list(g))) for t, g in groupby(Expression._normal_order_term(Term._decode(code)))]
+
+def _batch_job(job):
+    '''
+    Worker of the batch commands: job is a couple (operation, line) and the result is the couple (signed groups as (factor, Term string) couples, string of the result), or (None, "error: <message>") if the line is invalid.
+    '''
+    op, line = job
+    try:
+        return _batch_line(op, line)
+    except Exception as e:
+        return None, 'error: ' + str(e)
+
+def _batch_line(op, line):
+    parts = [Expression(p.strip()) for p in line.split(';')]
+
+    if op == 'normal-order':
+        P, N = parts[0], Expression()
+        for e in parts[1:]:
+            P = P + e
+    elif op == 'multiply':
+        P, N = parts[0], Expression()
+        for e in parts[1:]:
+            P = P * e
+    elif op == 'commutator':
+        if len(parts) != 2:
+            raise Exception('A commutator needs two Expressions separated by ";".')
+        P, N = parts[0].commutator(parts[1])
+
+    groups = [(c, str(t)) for t, c in Expression._signed_groups(P, N)]
+
+    return groups, Expression._signed_str(P, N)
+
+def _batch(args):
+    '''
+    Run a batch command: every non-empty line of every input (not starting with #) is processed by a pool of workers and the results are written in the same order. In JSON and pickle, an invalid line gives the dict {"error": message}.
+    '''
+    inputs = args.inputs or ['-']
+    extension = {'text': '.txt', 'json': '.json', 'pickle': '.pkl'}[args.format]
+
+    if args.output is not None:
+        outputs = {}
+        for name in inputs:
+            if name == '-':
+                continue
+            path = os.path.join(args.output, os.path.basename(name) + extension)
+            if path in outputs and outputs[path] != name:
+                raise Exception("Inputs '" + outputs[path] + "' and '" + name + "' would both be written to '" + path + "'.")
+            outputs[path] = name
+
+    executor = ProcessPoolExecutor(args.jobs) if args.jobs != 1 else None
+
+    for name in inputs:
+        start = time.time()
+
+        if name == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(name) as f:
+                lines = f.read().splitlines()
+        lines = [l.strip() for l in lines if l.strip() and not l.strip().startswith('#')]
+
+        jobs = [(args.command, l) for l in lines]
+        if executor is None:
+            results = [_batch_job(j) for j in jobs]
+        else:
+            results = list(executor.map(_batch_job, jobs, chunksize=max(1, len(jobs) // (4 * (args.jobs or os.cpu_count() or 1)))))
+
+        if args.format == 'text':
+            data = ''.join(r[1] + '\n' for r in results).encode()
+        else:
+            entries = [r[0] if r[0] is not None else {'error': r[1][len('error: '):]} for r in results]
+            data = json.dumps(entries).encode() + b'\n' if args.format == 'json' else pickle.dumps(entries)
+
+        if args.output is None or name == '-':
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        else:
+            with open(os.path.join(args.output, os.path.basename(name) + extension), 'wb') as f:
+                f.write(data)
+
+        num_terms = sum(len(r[0]) for r in results if r[0] is not None)
+        num_errors = sum(1 for r in results if r[0] is None)
+        print('{}: {} lines, {} terms, {} errors, {:.3f} s'.format(name, len(lines), num_terms, num_errors, time.time() - start), file=sys.stderr)
+
+    if executor is not None:
+        executor.shutdown()
+
+def main(argv=None):
+    '''
+    Command-line entry point, run with "python -m orderer".
+    '''
+    parser = argparse.ArgumentParser(prog='python -m orderer', description='Normal ordering of bosonic expressions.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cache_parser = commands.add_parser('cache', help='inspect or prune a persistent normal-order cache')
+    cache_commands = cache_parser.add_subparsers(dest='cache_command', required=True)
+
+    info_parser = cache_commands.add_parser('info', help='print the content of the cache')
+    info_parser.add_argument('path')
+
+    prune_parser = cache_commands.add_parser('prune', help='delete the entries of old versions and the least recently used ones')
+    prune_parser.add_argument('path')
+    prune_parser.add_argument('--max-entries', type=int, default=None)
+    prune_parser.add_argument('--all', action='store_true', help='delete every entry')
+
+    batch_options = argparse.ArgumentParser(add_help=False)
+    batch_options.add_argument('inputs', nargs='*', help='input files with one job per line (standard input if none or "-")')
+    batch_options.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (all the CPUs by default)')
+    batch_options.add_argument('-f', '--format', choices=['text', 'json', 'pickle'], default='text', help='output format: Expression strings, or lists of (factor, Term string) couples in JSON or pickle ({"error": message} for an invalid line)')
+    batch_options.add_argument('-o', '--output', help='directory where the result of each input file is written (standard output by default)')
+
+    commands.add_parser('normal-order', parents=[batch_options], help='normal-order the Expression of each line (several Expressions separated by ";" are summed)')
+    commands.add_parser('multiply', parents=[batch_options], help='multiply the Expressions of each line, separated by ";"')
+    commands.add_parser('commutator', parents=[batch_options], help='compute the commutator of the two Expressions of each line, separated by ";"')
+
+    serve_parser = commands.add_parser('serve', help='run a normal-ordering server with warm caches')
+    serve_parser.add_argument('--socket', help='path of the Unix socket to listen on')
+    serve_parser.add_argument('--port', type=int, default=0, help='localhost TCP port to listen on when no socket is given')
+    serve_parser.add_argument('--batch-delay', type=float, default=0.005, help='seconds to wait for other requests to batch with')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'cache':
+        cache = NormalOrderCache(args.path)
+
+        if args.cache_command == 'info':
+            info = cache.info()
+            print('path: {}'.format(info['path']))
+            print('entries: {}'.format(info['entries']))
+            for version, count in sorted(info['versions'].items()):
+                print('  version {}: {}'.format(version, count))
+            print('bytes: {}'.format(info['bytes']))
+        elif args.cache_command == 'prune':
+            print('deleted: {}'.format(cache.prune(args.max_entries, all_versions=args.all)))
+
+        cache.close()
+    elif args.command in ['normal-order', 'multiply', 'commutator']:
+        _batch(args)
+    elif args.command == 'serve':
+        server = NormalOrderServer(path=args.socket, port=args.port, batch_delay=args.batch_delay)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        server.ready.wait()
+        print('listening on ' + (args.socket or '127.0.0.1:{}'.format(server.port)), flush=True)
+
+        try:
+            thread.join()
+        except KeyboardInterrupt:
+            server.shutdown()
+            thread.join()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
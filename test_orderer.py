@@ -1,7 +1,19 @@
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
 import unittest
+from contextlib import redirect_stderr, redirect_stdout
 from time import sleep
 from orderer import *
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class TestSymbol(unittest.TestCase):
     def test00100_instanciateZero_NameAndBehaviorOK(self):
         # Arrange
@@ -1229,7 +1241,369 @@ class TestTerm(unittest.TestCase):
 
         # Assert
         self.assertEqual(res, "Term('k n xi* xi zeta a*^2 a^2 a* a b*^2 b b* b')")
-            
+
+    def test07000_disorderIndex_OK(self):
+        # Arrange
+        t = Term('k a* a a* b b* b a a*')
+
+        # Act
+
+        # Assert
+        self.assertEqual(t._disorders, {'a': 2, 'b': 6})
+        self.assertEqual(t._disorder, 2)
+
+    def test07100_disorderIndexNormalOrdered_None(self):
+        # Arrange
+        t = Term('z z* a* a b* b')
+
+        # Act
+
+        # Assert
+        self.assertEqual(t._disorders, {})
+        self.assertIsNone(t._disorder)
+
+    def test07200_isNormalOrderedOneSymbolOtherModeDisordered_True(self):
+        # Arrange
+        t = Term('a* a b b*')
+
+        # Act
+
+        # Assert
+        self.assertTrue(t.is_normal_ordered(symbol=self.a))
+        self.assertFalse(t.is_normal_ordered(symbol=self.b))
+
+    def test07300_mulTermsMergeKeepsOperatorOrder_OK(self):
+        # Arrange
+        t1 = Term('k z a a* b')
+        t2 = Term('x z* a* a b* b')
+
+        # Act
+        res = t1 * t2
+        expected_res = Term(t1.symbols + t2.symbols)
+
+        # Assert
+        self.assertEqual(res.symbols, expected_res.symbols)
+        self.assertEqual(res._disorders, {'a': 4, 'b': 8})
+
+    def test07400_mulTermsZeroAndOne_OK(self):
+        # Arrange
+        t = Term('z a a*')
+
+        # Act
+
+        # Assert
+        self.assertEqual(t * Term('1'), t)
+        self.assertEqual(Term('1') * t, t)
+        self.assertEqual(t * Term('0'), Term('0'))
+        self.assertEqual(Term('0') * t, Term('0'))
+        self.assertEqual(Term() * Term(), Term('1'))
+
+    def test07500_splitScalars_OK(self):
+        # Arrange
+        t = Term('a* k z a b')
+
+        # Act
+
+        # Assert
+        self.assertEqual(t.scalars, Term('k z').symbols)
+        self.assertEqual(t.word, Term('a* a b').symbols)
+        self.assertEqual(t._word_term(), Term('a* a b'))
+        self.assertEqual(Term('k z')._word_term(), Term('1'))
+
+    def test07600_normalOrderTermSharesWord_OK(self):
+        # Arrange
+        memo = {}
+
+        # Act
+        res_k = Expression._normal_order_term(Term('k a a*'), memo)
+        res_z = Expression._normal_order_term(Term('z a a*'), memo)
+
+        # Assert
+        self.assertEqual(list(memo), [Term('a a*')])
+        self.assertEqual(Expression(res_k), Expression('k a* a + k'))
+        self.assertEqual(Expression(res_z), Expression('z a* a + z'))
+
+    def test07700_strCached_OK(self):
+        # Arrange
+        t = Term('a* k a^2')
+
+        # Act
+        res = str(t)
+
+        # Assert
+        self.assertEqual(res, 'k a* a^2')
+        self.assertIs(str(t), res)
+        self.assertEqual(str(t.symbols[1]), 'a*')
+        self.assertIs(str(t.symbols[1]), str(t.symbols[1]))
+
+    def test07800_modeLayout_OK(self):
+        # Arrange
+        t = Term('k z* a* a a* b')
+        a = Symbol('a', 'annihilation')
+        b = Symbol('b', 'annihilation')
+
+        # Act
+        modes = t._modes
+
+        # Assert
+        self.assertEqual(list(modes), [Symbol('k', 'real'), Symbol('z', 'complex'), a, b])
+        self.assertEqual(modes[a], (2, 3, 0b101))
+        self.assertEqual(t._degree, 5)
+        self.assertEqual(t._dominance_order(), [a, b, Symbol('z', 'complex'), Symbol('k', 'real')])
+        self.assertEqual(t._disorders, {'a': 3})
+        self.assertEqual(t._num_symbols_like(name='a', dag=True), 2)
+
+class TestIndexedSymbol(unittest.TestCase):
+    def test00100_instanciateIndexedSymbol_nameOK(self):
+        # Arrange
+
+        # Act
+        a3 = Symbol('a', 'annihilation', index=3)
+
+        # Assert
+        self.assertEqual(a3.name, 'a_3')
+        self.assertEqual(a3.family, 'a')
+        self.assertEqual(a3.index, 3)
+        self.assertEqual(str(a3.conj()), 'a_3*')
+        self.assertEqual(repr(a3), "Symbol('a', 'annihilation', dag=False, index=3)")
+
+    def test00200_indexedSymbolsOrderedByInteger_OK(self):
+        # Arrange
+        a = Symbol('a', 'annihilation')
+        a2 = Symbol('a', 'annihilation', index=2)
+        a10 = Symbol('a', 'annihilation', index=10)
+        b0 = Symbol('b', 'annihilation', index=0)
+
+        # Act
+        res = sorted([b0, a10, a2, a])
+
+        # Assert
+        self.assertEqual(res, [a, a2, a10, b0])
+
+    def test00300_hashConsistentWithEquality_OK(self):
+        # Arrange
+        a3 = Symbol('a', 'annihilation', index=3)
+
+        # Act
+        d = {a3: 1, Term('a_3 a_3*'): 2}
+
+        # Assert
+        self.assertEqual(d[Symbol('a', 'annihilation', index=3)], 1)
+        self.assertEqual(d[Term('a_3 a_3*')], 2)
+        self.assertNotIn(a3.conj(), d)
+        self.assertNotEqual(Symbol('a_3', 'annihilation'), a3)
+
+    def test00400_parseIndexedFamily_OK(self):
+        # Arrange
+        a2 = Symbol('a', 'annihilation', index=2)
+        a10 = Symbol('a', 'annihilation', index=10)
+
+        # Act
+        t = Term('a_10* a_2^2')
+
+        # Assert
+        self.assertEqual(t.symbols, [a2, a2, a10.conj()])
+        self.assertEqual(str(t), 'a_2^2 a_10*')
+
+    def test00500_parseUnknownFamily_error(self):
+        # Arrange
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: Term('c_1'))
+        self.assertRaises(Exception, lambda: Term('a_x'))
+
+    def test00600_normalOrderIndexedModes_OK(self):
+        # Arrange
+        e = Expression('a_1 a_2 a_1* a_2*')
+
+        # Act
+
+        # Assert
+        self.assertEqual(e, Expression('a_1* a_1 a_2* a_2 + a_1* a_1 + a_2* a_2 + 1'))
+
+    def test00700_encodeDecode_OK(self):
+        # Arrange
+        t = Term('k z* a a_3 a_12* b_0')
+
+        # Act
+        res = Term._decode(t._encode())
+
+        # Assert
+        self.assertEqual(res, t)
+        self.assertEqual([s.index for s in res.symbols], [s.index for s in t.symbols])
+
+class TestIndexedSum(unittest.TestCase):
+    def setUp(self):
+        self.hopping = 'a_{i}* a_{i+1} + a_{i+1}* a_{i}'
+
+    def test00100_expandOpenBoundaries_OK(self):
+        # Arrange
+        h = IndexedSum(self.hopping, range(3))
+
+        # Act
+        res = h.expand()
+
+        # Assert
+        self.assertEqual(res, Expression('a_0* a_1 + a_1* a_0 + a_1* a_2 + a_2* a_1'))
+
+    def test00200_productCoincidentSites_OK(self):
+        # Arrange
+        s1 = IndexedSum('a_{i}', range(4))
+        s2 = IndexedSum('a_{i}*', range(4))
+
+        # Act
+        res = s1 * s2
+
+        # Assert
+        self.assertEqual(len(res.templates), 3)
+        self.assertEqual(res.expand(), s1.expand() * s2.expand())
+
+    def test00300_squareTemplateCountIndependentOfSites_OK(self):
+        # Arrange
+        h_small = IndexedSum(self.hopping, range(4))
+        h_big = IndexedSum(self.hopping, range(40))
+
+        # Act
+        res_small = h_small * h_small
+        res_big = h_big * h_big
+
+        # Assert
+        self.assertEqual(len(res_small.templates), len(res_big.templates))
+        self.assertEqual(res_small.expand(), h_small.expand() * h_small.expand())
+
+    def test00400_cubeMatchesExpandedProduct_OK(self):
+        # Arrange
+        h = IndexedSum(self.hopping, range(4))
+        e = h.expand()
+
+        # Act
+        res = h * h * h
+
+        # Assert
+        self.assertEqual(res.expand(), e * e * e)
+
+    def test00500_mulAndAddExpression_OK(self):
+        # Arrange
+        h = IndexedSum('k a_{i}* a_{i}', range(3))
+        b = Expression('b* + 1')
+
+        # Act
+        res = b * h + h
+
+        # Assert
+        self.assertEqual(res.expand(), b * h.expand() + h.expand())
+
+    def test00600_differentSites_error(self):
+        # Arrange
+        h1 = IndexedSum(self.hopping, range(3))
+        h2 = IndexedSum(self.hopping, range(4))
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: h1 * h2)
+
+    def test00700_placeholdersAndExplicitMembers_error(self):
+        # Arrange
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: IndexedSum('a_{i} a_0*', range(3)))
+
+class TestSymbolBank(unittest.TestCase):
+    def setUp(self):
+        self.a = Symbol('a', 'annihilation')
+        self.c = Symbol('c', 'annihilation')
+        self.g = Symbol('g', 'real')
+
+    def test00100_lookupByName_OK(self):
+        # Arrange
+        bank = SymbolBank([self.a, self.g])
+
+        # Act
+
+        # Assert
+        self.assertIs(bank['a'], self.a)
+        self.assertIs(bank['g'], self.g)
+        self.assertEqual(bank['0'], ZERO)
+        self.assertEqual(bank['1'], ONE)
+        self.assertEqual(len(bank), 4)
+
+    def test00200_lookupUnknownName_error(self):
+        # Arrange
+        bank = SymbolBank([self.a])
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: bank['c'])
+
+    def test00300_sameNameTwice_error(self):
+        # Arrange
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: SymbolBank([self.a, Symbol('a', 'complex')]))
+
+    def test00400_zeroAndOneAccepted_OK(self):
+        # Arrange
+
+        # Act
+        bank = SymbolBank([ZERO, self.a, ONE])
+
+        # Assert
+        self.assertEqual(len(bank), 3)
+
+    def test00500_addToFrozenBank_error(self):
+        # Arrange
+        bank = SymbolBank([self.a]).freeze()
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: bank.add(self.c))
+        self.assertRaises(Exception, lambda: Term._default_bank.add(self.c))
+
+    def test00600_termAndExpressionWithBank_OK(self):
+        # Arrange
+        bank = SymbolBank([self.a, self.c, self.g])
+
+        # Act
+        t = Term('g c c*', bank)
+        e = Expression('g c c* + 2 a', bank)
+
+        # Assert
+        self.assertEqual(t, Term([self.g, self.c, self.c.conj()]))
+        self.assertEqual(e, Expression([Term([self.g, self.c.conj(), self.c]), Term([self.g]), Term([self.a]), Term([self.a])]))
+
+    def test00700_listBankNotModified_OK(self):
+        # Arrange
+        bank = [self.a]
+
+        # Act
+        Term('a 1', bank)
+
+        # Assert
+        self.assertEqual(bank, [self.a])
+
+    def test00800_containsIndexedMember_OK(self):
+        # Arrange
+        bank = SymbolBank([self.a])
+
+        # Act
+
+        # Assert
+        self.assertIn('a', bank)
+        self.assertIn('a_3', bank)
+        self.assertEqual(bank['a_3'], Symbol('a', 'annihilation', index=3))
+        self.assertNotIn('a_x', bank)
+        self.assertNotIn('b_3', bank)
+        self.assertEqual(len(bank), 3) # Looking up members does not add them
+
 class TestExpression(unittest.TestCase):
     def setUp(self):
         self.k = Symbol('k', 'real')
@@ -1638,6 +2012,1171 @@ class TestExpression(unittest.TestCase):
         # Assert
         self.assertEqual(e1, e2)
 
+    def test03810_normalOrderDisorderInSecondMode_OK(self):
+        # Arrange
+        e = Expression('a b* b b*')
+
+        # Act
+        e.normal_order()
+
+        # Assert
+        self.assertEqual(e, Expression('a b*^2 b + a b*'))
+
+    @unittest.skipIf(np is None, 'numpy and scipy are not installed')
+    def test03900_sparseMatrixOneMode_OK(self):
+        # Arrange
+        e = Expression('a a*')
+
+        # Act
+        res = e.to_sparse_matrix({'a': 4})
+
+        # Assert
+        self.assertEqual(res.format, 'csr')
+        self.assertTrue(np.allclose(res.toarray(), np.diag([1, 2, 3, 4])))
+
+    @unittest.skipIf(np is None, 'numpy and scipy are not installed')
+    def test04000_sparseMatrixTwoModesScalars_OK(self):
+        # Arrange
+        e = Expression('z a* b + 2 k')
+        a = np.diag(np.sqrt(np.arange(1, 3)), 1)
+        b = np.diag(np.sqrt(np.arange(1, 4)), 1)
+
+        # Act
+        res = e.to_sparse_matrix({'a': 3, 'b': 4}, {'z': 1j, 'k': 0.5})
+        expected_res = 1j * np.kron(a.T, b) + np.identity(12)
+
+        # Assert
+        self.assertTrue(np.allclose(res.toarray(), expected_res))
+
+    @unittest.skipIf(np is None, 'numpy and scipy are not installed')
+    def test04100_sparseMatrixMissingCutoffOrValue_error(self):
+        # Arrange
+        e = Expression('k a* b')
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: e.to_sparse_matrix({'a': 3}, {'k': 1}))
+        self.assertRaises(Exception, lambda: e.to_sparse_matrix({'a': 3, 'b': 3}))
+
+    def test04200_compileEvaluateAtPoint_OK(self):
+        # Arrange
+        e = Expression('a a* a a*^2 a + k b* b + 2')
+        alpha = 1 + 2j
+        beta = 0.5j
+
+        # Act
+        f = e.compile()
+        res = f({'a': alpha, 'b': beta, 'k': 3})
+        expected_res = abs(alpha) ** 6 + 5 * abs(alpha) ** 4 + 4 * abs(alpha) ** 2 + 3 * abs(beta) ** 2 + 2
+
+        # Assert
+        self.assertAlmostEqual(res, expected_res)
+
+    def test04300_compileSharesPowers_OK(self):
+        # Arrange
+        e = Expression('a*^2 a^2 + a^2 + a*^2')
+
+        # Act
+        source = e.compile().source
+
+        # Assert
+        self.assertEqual(source.count('**2'), 2)
+
+    def test04400_compileCached_sameFunction(self):
+        # Arrange
+        e1 = Expression('a* a + 1')
+        e2 = Expression('a a*')
+
+        # Act
+
+        # Assert
+        self.assertIs(e1.compile(), e2.compile())
+
+    def test04500_compileZero_zero(self):
+        # Arrange
+        e = Expression()
+
+        # Act
+        res = e.compile()({})
+
+        # Assert
+        self.assertEqual(res, 0)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test04600_compileEvaluateArrays_OK(self):
+        # Arrange
+        e = Expression('z a* a + a^2 + 1')
+        alpha = np.array([0, 1j, 2])
+
+        # Act
+        res = e.compile()({'a': alpha, 'z': 2})
+
+        # Assert
+        self.assertTrue(np.allclose(res, 2 * abs(alpha) ** 2 + alpha ** 2 + 1))
+
+    def test04700_lazyExpressionNotNormalOrdered_OK(self):
+        # Arrange
+
+        # Act
+        e = Expression('a a* + b b*', lazy=True)
+
+        # Assert
+        self.assertEqual(e.terms, [Term('a a*'), Term('b b*')])
+
+    def test04800_lazyExpressionArithmeticStaysLazy_OK(self):
+        # Arrange
+        e = Expression('a a*', lazy=True)
+        f = Expression('a')
+
+        # Act
+        res = e * f + f
+
+        # Assert
+        self.assertIn(Term('a a* a'), res.terms)
+        res.normal_order()
+        self.assertEqual(res, Expression('a a* a + a'))
+
+    def test04900_iterNormalOrdered_pairsOK(self):
+        # Arrange
+        e = Expression('a a* a a*^2 a + 2 b b* + k', lazy=True)
+
+        # Act
+        res = list(e.iter_normal_ordered())
+
+        # Assert
+        self.assertEqual(res, [(Term('a*^3 a^3'), 1), (Term('a*^2 a^2'), 5), (Term('a* a'), 4), (Term('b* b'), 2), (Term('1'), 2), (Term('k'), 1)])
+
+    def test05000_iterNormalOrderedSumsToNormalOrder_OK(self):
+        # Arrange
+        e = Expression('a^2 b a*^2 b*', lazy=True) * Expression('a a* + b* b', lazy=True)
+        terms = []
+
+        # Act
+        for t, factor in e.iter_normal_ordered():
+            terms.extend([t] * factor)
+        e.normal_order()
+
+        # Assert
+        self.assertEqual(Expression(terms), e)
+
+    def test05100_iterNormalOrderedZero_empty(self):
+        # Arrange
+        e = Expression(lazy=True)
+
+        # Act
+        res = list(e.iter_normal_ordered())
+
+        # Assert
+        self.assertEqual(res, [])
+
+    def test05200_coefficientOfMatchesNormalOrder_OK(self):
+        # Arrange
+        info = 'a a* a a*^2 a + k a^2 a*^2 b b* + 3 z b b*'
+        e = Expression(info, lazy=True)
+        expected_res = Expression(info)
+
+        # Act
+        res = [(t, e.coefficient_of(t)) for t, _ in expected_res._group_terms()]
+
+        # Assert
+        self.assertEqual(res, expected_res._group_terms())
+
+    def test05300_coefficientOfAbsentTerm_zero(self):
+        # Arrange
+        e = Expression('a a* a a*^2 a + z b b*', lazy=True)
+
+        # Act
+
+        # Assert
+        self.assertEqual(e.coefficient_of(Term('a*^2 a')), 0)
+        self.assertEqual(e.coefficient_of(Term('z* b* b')), 0)
+        self.assertEqual(e.coefficient_of(Term('0')), 0)
+
+    def test05400_coefficientOfNotNormalOrdered_error(self):
+        # Arrange
+        e = Expression('a a*', lazy=True)
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: e.coefficient_of(Term('a a*')))
+
+    def test05500_vacuumExpectation_OK(self):
+        # Arrange
+        e = Expression('a a* a a*^2 a + k a^2 a*^2 b b* + 3 z b b* + a^2 a*', lazy=True)
+
+        # Act
+        res = e.vacuum_expectation()
+
+        # Assert
+        self.assertEqual(res, Expression('3 z + 2 k'))
+
+    def test05600_contractionCounts_OK(self):
+        # Arrange
+        word = (False, False, True, True) # a^2 a*^2 = a*^2 a^2 + 4 a* a + 2
+
+        # Act
+        res = Expression._contraction_counts(word)
+
+        # Assert
+        self.assertEqual(res, [1, 4, 2])
+
+    def test05700_commutatorCancelsCommonTerms_OK(self):
+        # Arrange
+        e = Expression('a')
+        f = Expression('a*')
+
+        # Act
+        res = e.commutator(f)
+
+        # Assert
+        self.assertEqual(res, (Expression('1'), Expression()))
+
+    def test05800_commutatorNegativePart_OK(self):
+        # Arrange
+        n = Expression('a* a + b* b')
+        e = Expression('a^2 b* + a')
+
+        # Act
+        p, m = n.commutator(e)
+
+        # Assert
+        self.assertEqual(p, Expression())
+        self.assertEqual(m, Expression('a^2 b* + a'))
+        self.assertEqual(Expression._signed_str(p, m), '- a^2 b* - a')
+
+    def test05900_normalOrderMany_OK(self):
+        # Arrange
+        expressions = ['a a* + k b b*', Expression('z a a* + a* a', lazy=True), Expression('b b*'), '']
+
+        # Act
+        res = normal_order_many(expressions)
+
+        # Assert
+        self.assertEqual(res, [Expression('a* a + 1 + k b* b + k'), Expression('z a* a + z + a* a'), Expression('b* b + 1'), Expression('0')])
+
+    def test06000_normalOrderManyInParallel_OK(self):
+        # Arrange
+        expressions = [str(i + 1) + ' a a* b^2 b*^2 + x a^2 a*' for i in range(5)]
+
+        # Act
+        res = normal_order_many(expressions, processes=2)
+
+        # Assert
+        self.assertEqual(res, [Expression(e) for e in expressions])
+
+    def test06100_strCachedAndInvalidated_OK(self):
+        # Arrange
+        e = Expression('a a* + 2 k', lazy=True)
+
+        # Act
+        before = str(e)
+        e.normal_order()
+        after = str(e)
+        e.terms = [Term('b')]
+
+        # Assert
+        self.assertEqual(before, 'a a* + 2 k')
+        self.assertEqual(after, 'a* a + 2 k + 1')
+        self.assertIs(str(e), str(e))
+        self.assertEqual(str(e), 'b')
+
+    def test06200_writeTo_OK(self):
+        # Arrange
+        e = Expression('z a* a + 3 b + 2')
+        out = io.StringIO()
+        out_zero = io.StringIO()
+
+        # Act
+        e.write_to(out)
+        Expression('0').write_to(out_zero)
+
+        # Assert
+        self.assertEqual(out.getvalue(), str(e))
+        self.assertEqual(out_zero.getvalue(), '0')
+
+    def test06300_antiNormalOrder_OK(self):
+        # Arrange
+        e = Expression('k a*^2 a^2 + a a*')
+
+        # Act
+        res = e.anti_normal_order()
+
+        # Assert
+        self.assertEqual(res.ordering, 'anti-normal')
+        self.assertEqual(res.coefficients, {Term('k a*^2 a^2'): 1, Term('k a* a'): -4, Term('a* a'): 1, Term('k'): 2})
+        self.assertEqual(str(res), 'k a^2 a*^2 - 4 k a a* + a a* + 2 k')
+
+    def test06400_weylOrder_OK(self):
+        # Arrange
+        e = Expression('a* a b* b')
+
+        # Act
+        res = e.weyl_order()
+
+        # Assert
+        self.assertEqual(str(res), '{a* a b* b} - 1/2 {a* a} - 1/2 {b* b} + 1/4')
+
+    def test06500_orderingRoundTrips_OK(self):
+        # Arrange
+        e = Expression('z a*^3 a^2 b + 2 a* a^4 + xi b*^2 b^2')
+
+        # Act
+        w = e.weyl_order()
+        an = e.anti_normal_order()
+
+        # Assert
+        self.assertEqual(w.to_ordering('anti-normal'), an)
+        self.assertEqual(an.to_ordering('weyl'), w)
+        self.assertEqual(w.to_expression(), e)
+        self.assertEqual(an.to_expression(), e)
+        self.assertRaises(Exception, lambda: OrderedExpression({Term('a* a'): -1}).to_expression())
+
+    def test06600_chargeIndex_OK(self):
+        # Arrange
+        e = Expression('a* a + k a* b + k b* a + z a*^2 + 2 a_10* a_2')
+
+        # Act
+        index = e.charge_index()
+
+        # Assert
+        self.assertEqual(Term('a_10* a_2').charge(), (('a_10', 1), ('a_2', -1)))
+        self.assertEqual(index[()], [(Term('a* a'), 1)])
+        self.assertEqual(index[(('a', 2),)], [(Term('z a*^2'), 1)])
+        self.assertEqual(e.block({'a': 1, 'b': -1}), Expression('k a* b'))
+        self.assertEqual(e.block({'a_2': -1, 'a_10': 1, 'b': 0}), Expression('2 a_10* a_2'))
+        self.assertEqual(e.block({'b': 3}), Expression('0'))
+
+    def test06700_commutesWithNumber_OK(self):
+        # Arrange
+        hopping = Expression('a* b + b* a + a* a b* b')
+        squeezing = Expression('a*^2 + a^2', lazy=True)
+
+        # Act
+
+        # Assert
+        self.assertTrue(hopping.commutes_with_number())
+        self.assertTrue(hopping.commutes_with_number('a', Symbol('b', 'annihilation')))
+        self.assertFalse(hopping.commutes_with_number('a'))
+        self.assertFalse(squeezing.commutes_with_number())
+        self.assertTrue(squeezing.commutes_with_number('b'))
+        self.assertEqual(hopping.commutes_with_number('a'), hopping.commutator(Expression('a* a')) == (Expression(), Expression()))
+
+    def test06900_lazyCompileEqualCommutator_normalOrdered(self):
+        # Arrange
+        e = Expression('a a*', lazy=True)
+
+        # Act
+        f = e.compile()
+
+        # Assert
+        self.assertEqual(f({'a': 1.0}), 2.0)
+        self.assertIs(Expression('a* a + 1').compile(), f) # Cached under the normal-ordered form
+        self.assertEqual(e, Expression('a* a + 1'))
+        self.assertEqual(Expression('a', lazy=True).commutator(Expression('a*', lazy=True)), (Expression('1'), Expression()))
+
+    def test07000_compileManyModes_OK(self):
+        # Arrange
+        e = Expression(' '.join('a_{0}* a_{0}'.format(i) for i in range(300)) + ' + 1')
+        values = {'a_{}'.format(i): 1.0 for i in range(300)}
+
+        # Act
+        res = e.compile()(values)
+
+        # Assert
+        self.assertEqual(res, 2.0)
+
+    def test07100_compileCacheBounded_OK(self):
+        # Arrange
+        size = Expression._compiled_max_entries
+
+        # Act
+        for k in range(size + 1):
+            Expression('{} a* a'.format(k + 2)).compile()
+
+        # Assert
+        self.assertLessEqual(len(Expression._compiled), size)
+
+    def test06800_normalOrderSharesWordAcrossScalars_OK(self):
+        # Arrange
+        info = 'k a a* a a* b b* + z a a* a a* b b* + x a a* a a* b b*'
+        word = Term('a a* a a* b b*')
+        expansions = []
+        normal_order_term = Expression._normal_order_term
+
+        def spy(t, memo=None):
+            if t._word_term() == word and (memo is None or word not in memo): # Shorter words come from the recursive normal ordering
+                expansions.append(word)
+            return normal_order_term(t, memo)
+
+        # Act
+        Expression._normal_order_term = staticmethod(spy)
+        try:
+            e = Expression(info)
+            pairs = list(Expression(info, lazy=True).iter_normal_ordered())
+        finally:
+            Expression._normal_order_term = staticmethod(normal_order_term)
+
+        # Assert
+        self.assertEqual(expansions, [word] * 2) # Once for normal_order, once for iter_normal_ordered
+        self.assertEqual(e, Expression('k a a* a a* b b*') + Expression('z a a* a a* b b*') + Expression('x a a* a a* b b*'))
+        self.assertEqual(Expression([t for t, factor in pairs for _ in range(factor)]), e)
+
+class TestHermitianExpression(unittest.TestCase):
+    def test00100_instanciateHalf_OK(self):
+        # Arrange
+        e = Expression('a* a + z a* + z* a + x a*^2 b + x a^2 b*')
+
+        # Act
+        h = HermitianExpression(e)
+
+        # Assert
+        self.assertEqual(h.pairs, [(Term('x a*^2 b'), 1), (Term('z a*'), 1)])
+        self.assertEqual(h.selfadjoint, [(Term('a* a'), 1)])
+        self.assertEqual(h.expression(), e)
+
+    def test00200_normalOrderHalf_OK(self):
+        # Arrange
+        info = 'a a* a a* + k b a* + k a b* + z a a*^2 + z* a^2 a*'
+
+        # Act
+        h = HermitianExpression(info)
+
+        # Assert
+        self.assertEqual(h.expression(), Expression(info))
+
+    def test00300_notHermitian_exception(self):
+        # Arrange
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: HermitianExpression('z a*'))
+        self.assertRaises(Exception, lambda: HermitianExpression('a* + 2 a'))
+
+    def test00400_squareAndPower_OK(self):
+        # Arrange
+        h = HermitianExpression('a* a + z a* + z* a + x a*^2 b + x a^2 b* + b a b* a*')
+        e = h.expression()
+
+        # Act
+        square = h.square()
+        cube = h.power(3)
+
+        # Assert
+        self.assertEqual(square.expression(), e * e)
+        self.assertEqual(cube.expression(), e * e * e)
+        self.assertEqual(square + h, HermitianExpression(e * e + e))
+
+class TestExpressionGraph(unittest.TestCase):
+    def test00100_internNodes_OK(self):
+        # Arrange
+        g = ExpressionGraph()
+        h = g.leaf('a* a + k')
+        a = g.leaf(Expression('a^2'))
+
+        # Act
+        x = h * a
+        y = g.leaf('a* a + k') * a
+
+        # Assert
+        self.assertIs(x, y)
+        self.assertIs(h + a, a + h)
+        self.assertIsNot(h * a, a * h)
+        self.assertEqual(len(g), 5)
+
+    def test00200_evaluate_OK(self):
+        # Arrange
+        g = ExpressionGraph()
+        h = g.leaf('a* a + z b')
+
+        # Act
+        x = (h * 'a' + h.conj()) * h + Term('k a*')
+
+        # Assert
+        self.assertIsNone(x._value)
+        self.assertEqual(Expression(x.evaluate().terms), (Expression('a* a + z b') * Expression('a') + Expression('a* a + z* b*')) * Expression('a* a + z b') + Expression('k a*'))
+        self.assertIs(x.evaluate(), x.evaluate())
+        self.assertEqual(str(x), str(x.evaluate()))
+
+    def test00300_commutatorSharesProducts_OK(self):
+        # Arrange
+        g = ExpressionGraph()
+        h = g.leaf('a* a')
+        a = g.leaf('a + b*')
+
+        # Act
+        P, N = h.commutator(a)
+        n = len(g)
+        h.commutator(a)
+
+        # Assert
+        self.assertEqual((P, N), Expression('a* a').commutator(Expression('a + b*')))
+        self.assertEqual(len(g), n)
+        self.assertIsNotNone((h * a)._value)
+
+    def test00400_evaluateDeepGraph_OK(self):
+        # Arrange
+        g = ExpressionGraph()
+        x = g.leaf('0')
+
+        # Act
+        for _ in range(300):
+            x = x + 'a'
+
+        # Assert
+        self.assertEqual(x.evaluate(), Expression('300 a'))
+
+    def test00500_invalidOperand_exception(self):
+        # Arrange
+        g = ExpressionGraph()
+        x = g.leaf('a* a')
+
+        # Act
+
+        # Assert
+        with self.assertRaisesRegex(Exception, "Unknown symbol 'c'"):
+            x * 'c'
+        with self.assertRaisesRegex(Exception, "Unknown symbol 'c'"):
+            'c' + x
+        with self.assertRaisesRegex(Exception, 'different ExpressionGraphs'):
+            x + ExpressionGraph().leaf('a')
+        self.assertRaises(TypeError, lambda: x * 2.5)
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestCoherentEvaluator(unittest.TestCase):
+    def test00100_exponentTable_OK(self):
+        # Arrange
+        e = Expression('a*^2 a + 3 k a')
+
+        # Act
+        ev = CoherentEvaluator(e)
+
+        # Assert
+        self.assertEqual(ev.names, ['a', 'k'])
+        self.assertEqual(ev.exponents.tolist(), [[[1, 2], [0, 0]], [[1, 0], [1, 0]]])
+        self.assertEqual(ev.coefs.tolist(), [1, 3])
+
+    def test00200_evaluateArrays_OK(self):
+        # Arrange
+        e = Expression('a a* + z b* b + 2')
+        alpha = np.array([0, 1j, 2])
+        beta = np.array([1, 1 + 1j, -1])
+        z = np.array([3, 1j, 0.5])
+
+        # Act
+        res = CoherentEvaluator(e)({'a': alpha, 'b': beta, 'z': z})
+        expected_res = abs(alpha) ** 2 + 1 + z * abs(beta) ** 2 + 2
+
+        # Assert
+        self.assertTrue(np.allclose(res, expected_res))
+
+    def test00300_evaluateBroadcastScalar_OK(self):
+        # Arrange
+        e = Expression('k a^2')
+        alpha = np.linspace(0, 1, 5)
+
+        # Act
+        res = CoherentEvaluator(e)({'a': alpha, 'k': 2})
+
+        # Assert
+        self.assertTrue(np.allclose(res, 2 * alpha ** 2))
+
+    def test00400_evaluateZero_zero(self):
+        # Arrange
+        e = Expression()
+
+        # Act
+        res = CoherentEvaluator(e)({})
+
+        # Assert
+        self.assertEqual(res, 0)
+
+    def test00500_evaluateMissingValue_error(self):
+        # Arrange
+        ev = CoherentEvaluator(Expression('k a'))
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: ev({'a': 1}))
+
+    def test00600_evaluateLazy_normalOrdered(self):
+        # Arrange
+        e = Expression('a a*', lazy=True)
+
+        # Act
+        res = CoherentEvaluator(e)({'a': 1.0})
+
+        # Assert
+        self.assertEqual(res, 2) # a a* = a* a + 1
+
+class TestIncrementalPower(unittest.TestCase):
+    def test00100_instanciateIncrementalPower_OK(self):
+        # Arrange
+        h = Expression('a* a + k a')
+
+        # Act
+        inc = IncrementalPower(h, 3)
+
+        # Assert
+        self.assertEqual(inc.expression, h)
+        self.assertEqual(inc[2], h * h)
+        self.assertEqual(inc[3], h * h * h)
+        with self.assertRaises(Exception):
+            inc[4]
+
+    def test00200_updateAddRemove_OK(self):
+        # Arrange
+        inc = IncrementalPower('a* a + k a + b*', 3)
+
+        # Act
+        inc.update(added='z a a + b* b', removed='k a')
+        h = Expression('a* a + z a^2 + b* + b* b')
+
+        # Assert
+        self.assertEqual(inc.expression, h)
+        self.assertEqual(inc[2], h * h)
+        self.assertEqual(inc[3], h * h * h)
+
+    def test00300_updateRemoveAll_zero(self):
+        # Arrange
+        inc = IncrementalPower('a* a + a', 2)
+
+        # Act
+        inc.update(removed='a + a* a')
+
+        # Assert
+        self.assertEqual(inc.expression, Expression('0'))
+        self.assertEqual(inc[2], Expression('0'))
+
+    def test00400_updateRemoveMissing_exception(self):
+        # Arrange
+        inc = IncrementalPower('a* a', 2)
+
+        # Act
+
+        # Assert
+        with self.assertRaises(Exception):
+            inc.update(removed='a')
+
+    def test00450_applyKeepsOrder_OK(self):
+        # Arrange
+        e = Expression('a* a + 2 k a + b* b + 1')
+
+        # Act
+        res = IncrementalPower._apply(e, Expression('3 k a + z + a*^2'), Expression('a* a + 1'))
+
+        # Assert
+        self.assertEqual(res, Expression('5 k a + b* b + z + a*^2'))
+
+    def test00500_incrementalCommutator_OK(self):
+        # Arrange
+        f = Expression('a* a')
+        inc = IncrementalCommutator('a + b', f)
+
+        # Act
+        inc.update(added='a*^2', removed='a')
+        P, N = Expression('b + a*^2').commutator(f)
+
+        # Assert
+        self.assertEqual(inc.P, P)
+        self.assertEqual(inc.N, N)
+
+class TestDiskExpression(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test00100_runsMergedInOrder_OK(self):
+        # Arrange
+        e = Expression('a a* + k b + 2 z a*^2 + b* b')
+
+        # Act
+        with DiskExpression(self.dir.name, run_size=2, max_runs=100) as d:
+            d.extend(Expression('a a* + k b', lazy=True))
+            d.extend([Term('z a*^2'), Term('b* b'), Term('z a*^2')])
+            num_runs = len(d._runs)
+            res = d.to_expression()
+
+        # Assert
+        self.assertGreater(num_runs, 1)
+        self.assertEqual(res, e)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test00200_compactRuns_OK(self):
+        # Arrange
+        d = DiskExpression(self.dir.name, run_size=1, max_runs=3)
+
+        # Act
+        for i in range(10):
+            d.add(Term('a*^{} a'.format(i % 4)) if i % 4 else Term('a'), 2)
+        num_runs = len(d._runs)
+        res = list(d._group_terms())
+        d.close()
+
+        # Assert
+        self.assertLessEqual(num_runs, 3)
+        self.assertEqual(res, Expression('6 a + 6 a* a + 4 a*^2 a + 4 a*^3 a')._group_terms())
+
+    def test00300_multiply_OK(self):
+        # Arrange
+        h = Expression('a* a + z a + b*')
+        d = DiskExpression(run_size=3)
+        d.extend(h)
+
+        # Act
+        d2 = d * h
+        d3 = d2 * d
+        d_left = Term('k a') * d
+        res = [d2.to_expression(), d3.to_expression(), d_left.to_expression()]
+        for x in [d, d2, d3, d_left]:
+            x.close()
+
+        # Assert
+        self.assertEqual(res, [h * h, h * h * h, Term('k a') * h])
+
+class TestNormalOrderPlanner(unittest.TestCase):
+    def tearDown(self):
+        Expression.cache = None
+
+    def test00100_estimate_OK(self):
+        # Arrange
+        e = Expression('a a* a a* + 2 k b b* a', lazy=True)
+
+        # Act
+        res = NormalOrderPlanner().estimate(e)
+
+        # Assert
+        self.assertEqual(res, {'terms': 9, 'distinct_terms': 5, 'work': 32})
+        self.assertEqual(res['terms'], sum(c for _, c in Expression(e.terms)._group_terms()))
+
+    def test00200_chooseEngine_OK(self):
+        # Arrange
+        e = Expression('a^3 a*^3 b^2 b*^2', lazy=True)
+        planner = NormalOrderPlanner(small_work=10, parallel_work=10**4)
+
+        # Act
+        small = planner.plan(Expression('a a*', lazy=True))['engine']
+        large = planner.plan(e)['engine']
+        res = planner.normal_order(e)
+
+        # Assert
+        self.assertEqual([small, large], ['rewrite', 'cached'])
+        self.assertEqual(res, Expression(e.terms))
+        self.assertEqual(NormalOrderPlanner(parallel_work=10).plan(e)['engine'], 'parallel')
+        self.assertEqual(NormalOrderPlanner(parallel_work=10, processes=None).plan(e)['engine'], 'cached')
+
+    def test00300_overBudget_exception(self):
+        # Arrange
+        planner = NormalOrderPlanner(budget=10**4)
+
+        # Act
+
+        # Assert
+        with self.assertRaises(Exception):
+            planner.normal_order('a^8 a*^8 b^4 b*^4')
+
+    def test00400_cachedEngineKeepsWords_OK(self):
+        # Arrange
+        planner = NormalOrderPlanner(small_work=10, processes=None)
+
+        # Act
+        res1 = planner.normal_order('k a^3 a*^3 b b*')
+        words = dict(planner._memo)
+        res2 = planner.normal_order('z a^3 a*^3 b b*')
+
+        # Assert
+        self.assertEqual(res1, Expression('k a^3 a*^3 b b*'))
+        self.assertEqual(res2, Expression('z a^3 a*^3 b b*'))
+        self.assertIn(Term('a^3 a*^3 b b*'), words)
+        self.assertEqual(planner._memo, words) # The second call only reused the expansion
+
+    def test00500_parallelEngineSharesPool_OK(self):
+        # Arrange
+        e = 'a^2 a*^2 b b* + k a a* b^2 b*^2'
+
+        # Act
+        with NormalOrderPlanner(parallel_work=1, processes=2) as planner:
+            res1 = planner.normal_order(e)
+            executor = planner._executor
+            res2 = planner.normal_order(e)
+            same_executor = planner._executor is executor
+
+        # Assert
+        self.assertEqual(res1, Expression(e))
+        self.assertEqual(res2, Expression(e))
+        self.assertTrue(same_executor)
+        self.assertIsNone(planner._executor)
+
+class TestNormalOrderCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache.db')
+        self.cache = NormalOrderCache(self.path)
+
+    def tearDown(self):
+        Expression.cache = None
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test00100_putGet_OK(self):
+        # Arrange
+        t = Term('k a a* b')
+        terms = Expression('k a* a b + k b').terms
+
+        # Act
+        self.cache.put(t, terms)
+        res = self.cache.get(t)
+
+        # Assert
+        self.assertEqual(res, terms)
+
+    def test00200_getUnknownTerm_None(self):
+        # Arrange
+
+        # Act
+        res = self.cache.get(Term('a a*'))
+
+        # Assert
+        self.assertIsNone(res)
+
+    def test00300_normalOrderFillsAndUsesCache_OK(self):
+        # Arrange
+        Expression.cache = self.cache
+        self.cache.min_symbols = 2
+
+        # Act
+        e = Expression('a a* b b*')
+        self.cache.put(Term('a a*'), Expression('b').terms) # Wrong on purpose, to check that the cache is read
+        e_cached = Expression('a a*')
+
+        # Assert
+        self.assertEqual(e, Expression('a* a b* b + a* a + b* b + 1'))
+        self.assertEqual(self.cache.get(Term('a a* b b*')), e.terms)
+        self.assertEqual(e_cached, Expression('b'))
+
+    def test00400_sharedBetweenConnections_OK(self):
+        # Arrange
+        other = NormalOrderCache(self.path)
+        t = Term('a a*')
+
+        # Act
+        self.cache.put(t, Expression('a* a + 1').terms)
+        res = other.get(t)
+        other.close()
+
+        # Assert
+        self.assertEqual(res, Expression('a* a + 1').terms)
+
+    def test00500_pruneLeastRecentlyUsed_OK(self):
+        # Arrange
+        t1 = Term('a a*')
+        t2 = Term('b b*')
+        t3 = Term('a a* a')
+        for t in [t1, t2, t3]:
+            self.cache.put(t, [Term()])
+            sleep(0.01)
+        self.cache.get(t1)
+
+        # Act
+        deleted = self.cache.prune(max_entries=2)
+
+        # Assert
+        self.assertEqual(deleted, 1)
+        self.assertIsNone(self.cache.get(t2))
+        self.assertIsNotNone(self.cache.get(t1))
+        self.assertIsNotNone(self.cache.get(t3))
+
+    def test00600_pruneOtherVersions_OK(self):
+        # Arrange
+        self.cache._conn.execute("INSERT INTO terms VALUES ('old', '0.0.1', '[]', 0)")
+
+        # Act
+        before = self.cache.info()['versions']
+        deleted = self.cache.prune()
+
+        # Assert
+        self.assertEqual(before, {'0.0.1': 1})
+        self.assertEqual(deleted, 1)
+        self.assertEqual(self.cache.info()['entries'], 0)
+
+    def test00700_commandLineInfoAndPrune_OK(self):
+        # Arrange
+        self.cache.put(Term('a a*'), Expression('a* a + 1').terms)
+        self.cache.put(Term('b b*'), Expression('b* b + 1').terms)
+        out = io.StringIO()
+
+        # Act
+        with redirect_stdout(out):
+            main(['cache', 'info', self.path])
+            main(['cache', 'prune', self.path, '--all'])
+
+        # Assert
+        self.assertIn('entries: 2', out.getvalue())
+        self.assertIn('deleted: 2', out.getvalue())
+        self.assertEqual(self.cache.info()['entries'], 0)
+
+    def test00800_shortWordsNotCached_OK(self):
+        # Arrange
+        Expression.cache = self.cache
+
+        # Act
+        e = Expression('a a* a a*')
+
+        # Assert
+        self.assertEqual(e, Expression('a*^2 a^2 + 3 a* a + 1'))
+        self.assertIsNotNone(self.cache.get(Term('a a* a a*')))
+        self.assertIsNone(self.cache.get(Term('a a*')))
+
+    def test00900_usedTimesWrittenInBatches_OK(self):
+        # Arrange
+        t = Term('a a* a a*')
+        self.cache.put(t, Expression('a*^2 a^2 + 3 a* a + 1').terms)
+        used = self.cache._conn.execute('SELECT used FROM terms').fetchone()[0]
+        sleep(0.01)
+
+        # Act
+        self.cache.get(t)
+        before = self.cache._conn.execute('SELECT used FROM terms').fetchone()[0]
+        self.cache.prune()
+        after = self.cache._conn.execute('SELECT used FROM terms').fetchone()[0]
+
+        # Assert
+        self.assertEqual(before, used)
+        self.assertGreater(after, used)
+
+    def test01000_sharedBetweenThreads_OK(self):
+        # Arrange
+        t = Term('b b* b b*')
+        results = []
+
+        # Act
+        thread = threading.Thread(target=lambda: self.cache.put(t, [Term('b')]))
+        thread.start()
+        thread.join()
+        thread = threading.Thread(target=lambda: results.append(self.cache.get(t)))
+        thread.start()
+        thread.join()
+
+        # Assert
+        self.assertEqual(results, [[Term('b')]])
+
+class TestNormalOrderServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'orderer.sock')
+        self.server = NormalOrderServer(path=self.path, batch_delay=0.05)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.server.ready.wait(5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(5)
+        self.dir.cleanup()
+
+    def test00100_normalOrderOverSocket_OK(self):
+        # Arrange
+        client = NormalOrderClient(self.path, timeout=5)
+
+        # Act
+        res = client.normal_order('a a* a a*^2 a')
+        res_expr = client.normal_order(Expression('b b*', lazy=True))
+        client.close()
+
+        # Assert
+        self.assertEqual(res, Expression('a*^3 a^3 + 5 a*^2 a^2 + 4 a* a'))
+        self.assertEqual(res_expr, Expression('b* b + 1'))
+
+    def test00200_concurrentClientsBatched_OK(self):
+        # Arrange
+        clients = [NormalOrderClient(self.path, timeout=5) for _ in range(3)]
+        results = [None] * 3
+
+        def run(i):
+            results[i] = clients[i].normal_order_many(['a a* + b', str(i) + ' a^2 a*'])
+
+        # Act
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join(5)
+        for c in clients:
+            c.close()
+
+        # Assert
+        for i in range(3):
+            self.assertEqual(results[i], [Expression('a* a + 1 + b'), Expression(str(i) + ' a^2 a*')])
+        self.assertIn(Term('a a*'), self.server._ordered)
+        self.assertIn('a^2 a*', self.server._parsed)
+
+    def test00300_badExpression_error(self):
+        # Arrange
+        client = NormalOrderClient(self.path, timeout=5)
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: client.normal_order('c c*'))
+        self.assertEqual(client.normal_order('a a*'), Expression('a* a + 1'))
+        client.close()
+
+    def test00400_batchSharesTerms_OK(self):
+        # Arrange
+
+        # Act
+        res = self.server.normal_order_batch(['a a* + a a*', '2 a a*', ''])
+
+        # Assert
+        self.assertEqual(res, ['2 a* a + 2', '2 a* a + 2', '0'])
+        self.assertEqual(list(self.server._ordered), [Term('a a*')])
+
+    def test00500_pipelinedLinesBatchedTogether_OK(self):
+        # Arrange
+        client = NormalOrderClient(self.path, timeout=5)
+        sizes = []
+        normal_order_batch = self.server.normal_order_batch
+        self.server.normal_order_batch = lambda infos: sizes.append(len(infos)) or normal_order_batch(infos)
+
+        # Act
+        res = client.normal_order_many([str(i + 1) + ' a a*' for i in range(20)])
+        client.close()
+
+        # Assert
+        self.assertEqual(sizes, [20])
+        self.assertEqual(res[19], Expression('20 a* a + 20'))
+
+    def test00600_failingBatch_error(self):
+        # Arrange
+        client = NormalOrderClient(self.path, timeout=5)
+        self.server.normal_order_batch = lambda infos: 1 / 0
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: client.normal_order_many(['a a*', 'b b*']))
+        client.close()
+
+    def test00700_sharedCache_OK(self):
+        # Arrange
+        d = tempfile.TemporaryDirectory()
+        Expression.cache = NormalOrderCache(os.path.join(d.name, 'cache.db'))
+        client = NormalOrderClient(self.path, timeout=5)
+
+        # Act
+        try:
+            res = client.normal_order('a a* a a*')
+        finally:
+            client.close()
+            Expression.cache.close()
+            Expression.cache = None
+            d.cleanup()
+
+        # Assert
+        self.assertEqual(res, Expression('a*^2 a^2 + 3 a* a + 1'))
+
+    def test00800_memosBounded_OK(self):
+        # Arrange
+        server = NormalOrderServer(max_entries=2)
+        infos = ['a a*', 'b b*', 'a^2 a*', 'b^2 b*', 'k a a*']
+
+        # Act
+        res = [server.normal_order_batch([info])[0] for info in infos]
+
+        # Assert
+        self.assertEqual(res, [str(Expression(info)) for info in infos])
+        self.assertLessEqual(len(server._parsed), 2)
+        self.assertLessEqual(len(server._ordered), 2)
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.dir.name, 'h.txt')
+        with open(self.input, 'w') as f:
+            f.write('# Hamiltonians\na a* ; b\n\na* a ; a\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_main(self, argv):
+        err = io.StringIO()
+        with redirect_stderr(err):
+            main(argv + ['-o', self.dir.name])
+        return err.getvalue()
+
+    def read_output(self, extension, mode='r'):
+        with open(self.input + extension, mode) as f:
+            return f.read()
+
+    def test00100_normalOrderText_OK(self):
+        # Arrange
+
+        # Act
+        err = self.run_main(['normal-order', self.input, '-j', '1'])
+
+        # Assert
+        self.assertEqual(self.read_output('.txt'), 'a* a + b + 1\na* a + a\n')
+        self.assertIn('h.txt: 2 lines, 5 terms, 0 errors', err)
+
+    def test00200_multiplyParallelJson_OK(self):
+        # Arrange
+
+        # Act
+        self.run_main(['multiply', self.input, '-j', '2', '-f', 'json'])
+
+        # Assert
+        self.assertEqual(json.loads(self.read_output('.json')), [[[1, 'a* a b'], [1, 'b']], [[1, 'a* a^2']]])
+
+    def test00300_commutatorPickle_OK(self):
+        # Arrange
+
+        # Act
+        self.run_main(['commutator', self.input, '-j', '1', '-f', 'pickle'])
+
+        # Assert
+        self.assertEqual(pickle.loads(self.read_output('.pkl', 'rb')), [[], [(-1, 'a')]])
+
+    def test00400_invalidLine_errorReported(self):
+        # Arrange
+        with open(self.input, 'w') as f:
+            f.write('a a*\nc\n')
+
+        # Act
+        err = self.run_main(['normal-order', self.input, '-j', '1'])
+
+        # Assert
+        self.assertEqual(self.read_output('.txt'), "a* a + 1\nerror: Unknown symbol 'c'.\n")
+        self.assertIn('1 errors', err)
+
+    def test00500_invalidLineJson_errorEntry(self):
+        # Arrange
+        with open(self.input, 'w') as f:
+            f.write('a a*\nc\n')
+
+        # Act
+        self.run_main(['normal-order', self.input, '-j', '1', '-f', 'json'])
+
+        # Assert
+        self.assertEqual(json.loads(self.read_output('.json')), [[[1, 'a* a'], [1, '1']], {'error': "Unknown symbol 'c'."}])
+
+    def test00600_sameBasename_exception(self):
+        # Arrange
+        other = os.path.join(self.dir.name, 'sub')
+        os.mkdir(other)
+        with open(os.path.join(other, 'h.txt'), 'w') as f:
+            f.write('a\n')
+
+        # Act
+
+        # Assert
+        self.assertRaises(Exception, lambda: self.run_main(['normal-order', self.input, os.path.join(other, 'h.txt'), '-j', '1']))
+        self.assertFalse(os.path.exists(self.input + '.txt')) # Checked before any input is processed
+
 if __name__ == '__main__':
     verb = 1 # Verbosity
 
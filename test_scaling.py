@@ -0,0 +1,124 @@
+import json
+import math
+import os
+import time
+import unittest
+from orderer import *
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scaling_baseline.json')
+WRITE_BASELINE = os.environ.get('ORDERER_WRITE_BASELINE') == '1' # Set to 1 to store the measured exponents as the new baseline
+RUN_SCALING = os.environ.get('ORDERER_SCALING') == '1' or WRITE_BASELINE # Set to 1 to run the timing sweeps, which are skipped by default since timings depend on the machine load
+TOLERANCE = 0.5 # Allowed increase of an exponent over its baseline, timings being noisy
+
+def best_time(f, repeats=9):
+    '''
+    Return the best wall time of repeats calls to f.
+    '''
+    res = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        res = elapsed if res is None else min(res, elapsed)
+
+    return res
+
+def fit_exponent(sizes, times):
+    '''
+    Return the slope of the least-squares line through the points (log size, log time).
+    '''
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+def modes_term(m, pattern):
+    '''
+    Return the Term made of pattern (like "a_{0}* a_{0}") repeated for the modes 0 to m - 1.
+    '''
+    return Term(' '.join(pattern.format(i) for i in range(m)))
+
+@unittest.skipUnless(RUN_SCALING, 'set ORDERER_SCALING=1 to run the scaling sweeps')
+class TestScaling(unittest.TestCase):
+    '''
+    Each test runs a hot operation over a geometric sweep of sizes, fits the growth exponent of its running time and checks it against a declared bound and against the exponent stored in scaling_baseline.json.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.measured = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as f:
+                cls.baseline = json.load(f)
+        else:
+            cls.baseline = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if WRITE_BASELINE:
+            baseline = dict(cls.baseline)
+            baseline.update({name: round(exponent, 2) for name, exponent in cls.measured.items()})
+            with open(BASELINE_PATH, 'w') as f:
+                json.dump(baseline, f, indent=4, sort_keys=True)
+                f.write('\n')
+
+    def check_scaling(self, name, sizes, make, bound):
+        '''
+        Time the function make(n) for every n in sizes and check the fitted exponent.
+        '''
+        times = [best_time(make(n)) for n in sizes]
+        exponent = fit_exponent(sizes, times)
+        self.measured[name] = exponent
+
+        self.assertLessEqual(exponent, bound, '{}: exponent {:.2f} exceeds the declared bound {}'.format(name, exponent, bound))
+        if name in self.baseline and not WRITE_BASELINE:
+            self.assertLessEqual(exponent, self.baseline[name] + TOLERANCE, '{}: exponent {:.2f} regressed from the baseline {}'.format(name, exponent, self.baseline[name]))
+
+    def test00100_termLtWordLength_OK(self):
+        def make(n):
+            A = Term('a*^{0} a^{0} b'.format(n))
+            B = Term('a*^{0} a^{0} b*'.format(n))
+            return lambda: [A < B for _ in range(50)]
+
+        self.check_scaling('Term.__lt__ / word length', [16, 32, 64, 128, 256], make, 1.5)
+
+    def test00200_termLtModeCount_OK(self):
+        def make(m):
+            A = modes_term(m, 'a_{0}* a_{0}') * Term('b')
+            B = modes_term(m, 'a_{0}* a_{0}') * Term('b*') # Only the last mode differs
+            return lambda: [A < B for _ in range(25)]
+
+        self.check_scaling('Term.__lt__ / mode count', [16, 32, 64, 128, 256], make, 1.5)
+
+    def test00300_termMulModeCount_OK(self):
+        def make(m):
+            A = modes_term(m, 'a_{0}* a_{0}')
+            B = modes_term(m, 'b_{0}')
+            return lambda: [A * B for _ in range(50)]
+
+        self.check_scaling('Term.__mul__ / mode count', [16, 32, 64, 128, 256], make, 1.5)
+
+    def test00400_expressionTermCount_OK(self):
+        def make(n):
+            terms = [Term('a_{0}* a_{0}'.format(i)) for i in range(n)]
+            return lambda: Expression(terms)
+
+        self.check_scaling('Expression() / term count', [100, 200, 400, 800, 1600], make, 1.5)
+
+    def test00500_normalOrderWordLength_OK(self):
+        def make(n):
+            info = 'a^{} a*'.format(n)
+            return lambda: Expression(info)
+
+        self.check_scaling('Expression.normal_order / word length', [4, 8, 16, 32], make, 3.5)
+
+    def test00600_normalOrderModeCount_OK(self):
+        def make(m):
+            info = 'a a* ' + str(modes_term(m, 'b_{0}* b_{0}'))
+            return lambda: Expression(info)
+
+        self.check_scaling('Expression.normal_order / mode count', [8, 16, 32, 64], make, 2.0)
+
+if __name__ == '__main__':
+    unittest.main()